@@ -11,7 +11,10 @@ let lastX = 0;
 let lastY = 0;
 
 let currentTab = 'Mode'; // Default tab is 'Mode' - should not be hardcoded
+const MAX_LOGS = 100; // Log messages kept in the logs store
+const TAB_NAMES = ['Mode', 'Segmentation', 'Inpainting', 'Export', 'Configuration'];
 let currentSlice = null; // Default slice is null
+let rectRequest = 0; // Latest store_rect_coords request, for coalescing scroll events
 
 // For Zooming
 let zoomLevel = 1;
@@ -320,24 +323,115 @@ window.dash_clientside = Object.assign({}, window.dash_clientside, {
             resetContext();
             return window.dash_clientside.no_update;
         },
+        render_last_logs: function (logs) {
+            if (!logs) {
+                return [window.dash_clientside.no_update, window.dash_clientside.no_update];
+            }
+            // render the three most recent log messages
+            const children = logs.slice(-3).map(log => ({
+                namespace: 'dash_html_components',
+                type: 'Div',
+                props: { children: log }
+            }));
+            // every callback that logs sends the whole list both ways, so keep it bounded
+            const trimmed = logs.length > MAX_LOGS ? logs.slice(-MAX_LOGS) : window.dash_clientside.no_update;
+            return [children, trimmed];
+        },
+        update_current_tab: function (classNames) {
+            // the first tab content that is not hidden is the current tab
+            const index = classNames.findIndex(name => !name.includes('hidden'));
+            if (index < 0) {
+                return window.dash_clientside.no_update;
+            }
+            return TAB_NAMES[index];
+        },
+        download_url: function (url) {
+            if (!url) {
+                return window.dash_clientside.no_update;
+            }
+            // let the browser stream the file instead of receiving it inside the callback response
+            const link = document.createElement('a');
+            link.href = url;
+            link.download = '';
+            document.body.appendChild(link);
+            link.click();
+            link.remove();
+            return window.dash_clientside.no_update;
+        },
+        threshold_sliders: function (values) {
+            if (!Array.isArray(values)) {
+                return window.dash_clientside.no_update;
+            }
+            // same components as dcc.Slider inside an html.Div would serialize to
+            return values.map((value, i) => ({
+                namespace: 'dash_html_components',
+                type: 'Div',
+                props: {
+                    className: 'm-1 pl-1',
+                    children: [{
+                        namespace: 'dash_core_components',
+                        type: 'Slider',
+                        props: {
+                            id: { type: 'threshold-slider', index: i + 1 },
+                            min: 0,
+                            max: 255,
+                            step: 1,
+                            value: value,
+                            marks: null,
+                            tooltip: { always_visible: true, placement: 'right' },
+                        },
+                    }],
+                },
+            }));
+        },
+        toggle_slice_overlay: function (n_clicks, n_clicks_overlay, classNames) {
+            const triggered = window.dash_clientside.callback_context.triggered_id;
+            if (!triggered || !(n_clicks.some(Boolean) || n_clicks_overlay.some(Boolean))) {
+                return window.dash_clientside.no_update;
+            }
+            // clicking the selected slice deselects it; mirrors display_slice on the server
+            const selected = classNames[triggered.index] === 'hidden' ? triggered.index : null;
+            return classNames.map((className, i) => {
+                if (i === selected) {
+                    return 'overlay';
+                }
+                return className === 'hidden' ? window.dash_clientside.no_update : 'hidden';
+            });
+        },
+        show_depth_input: function (n_clicks, className) {
+            if (!n_clicks) {
+                return window.dash_clientside.no_update;
+            }
+            return className.replace('hidden', '');
+        },
         store_rect_coords: function () {
+            // Scroll events arrive faster than frames; only the last request
+            // in a frame measures the image, earlier ones leave the store alone.
+            const request = ++rectRequest;
             return new Promise((resolve, reject) => {
-                const graphElement = document.getElementById('image');
-                if (graphElement === null) {
-                    console.log('No element found with id "image"');
-                    resolve({ x: 0, y: 0, width: 0, height: 0 });
-                    return;
-                }
-
-                // Check if the image has already loaded
-                if (graphElement.complete && graphElement.naturalWidth !== 0) {
-                    resolveRect(graphElement, resolve);
-                } else {
-                    // If the image hasn't loaded yet, wait for the load event
-                    graphElement.addEventListener('load', () => {
+                requestAnimationFrame(() => {
+                    if (request !== rectRequest) {
+                        resolve(window.dash_clientside.no_update);
+                        return;
+                    }
+
+                    const graphElement = document.getElementById('image');
+                    if (graphElement === null) {
+                        console.log('No element found with id "image"');
+                        resolve({ x: 0, y: 0, width: 0, height: 0 });
+                        return;
+                    }
+
+                    // Check if the image has already loaded
+                    if (graphElement.complete && graphElement.naturalWidth !== 0) {
                         resolveRect(graphElement, resolve);
-                    });
-                }
+                    } else {
+                        // If the image hasn't loaded yet, wait for the load event
+                        graphElement.addEventListener('load', () => {
+                            resolveRect(graphElement, resolve);
+                        });
+                    }
+                });
             });
         },
         canvas_get: function () {
@@ -1,6 +1,6 @@
 # (c) 2024 Niels Provos
 
-from dash.dependencies import Input, Output, State, ClientsideFunction
+from dash.dependencies import Input, Output, State, ClientsideFunction, ALL, MATCH
 
 import constants as C
 
@@ -13,6 +13,51 @@ def make_clientside_callbacks(app):
         Input('evScroll', 'n_events'),
     )
 
+    app.clientside_callback(
+        ClientsideFunction(namespace='clientside',
+                           function_name='render_last_logs'),
+        Output('log', 'children'),
+        Output(C.LOGS_DATA, 'data', allow_duplicate=True),
+        Input(C.LOGS_DATA, 'data'),
+        prevent_initial_call=True
+    )
+
+    for download in [C.DOWNLOAD_IMAGE, C.DOWNLOAD_GLTF]:
+        app.clientside_callback(
+            ClientsideFunction(namespace='clientside',
+                               function_name='download_url'),
+            Output(C.STORE_IGNORE, 'data', allow_duplicate=True),
+            Input(download, 'data'),
+            prevent_initial_call=True
+        )
+
+    app.clientside_callback(
+        ClientsideFunction(namespace='clientside',
+                           function_name='threshold_sliders'),
+        Output(C.CTR_THRESHOLDS, 'children'),
+        Input(C.STORE_UPDATE_THRESHOLD_CONTAINER, 'data'),
+        prevent_initial_call=True
+    )
+
+    app.clientside_callback(
+        ClientsideFunction(namespace='clientside',
+                           function_name='toggle_slice_overlay'),
+        Output({'type': C.ID_SLICE_OVERLAY, 'index': ALL}, 'className'),
+        Input({'type': 'slice', 'index': ALL}, 'n_clicks'),
+        Input({'type': C.ID_SLICE_OVERLAY, 'index': ALL}, 'n_clicks'),
+        State({'type': C.ID_SLICE_OVERLAY, 'index': ALL}, 'className'),
+        prevent_initial_call=True
+    )
+
+    app.clientside_callback(
+        ClientsideFunction(namespace='clientside',
+                           function_name='show_depth_input'),
+        Output({'type': C.INPUT_SLICE_DEPTH, 'index': MATCH}, 'className'),
+        Input({'type': C.ID_SLICE_DEPTH_DISPLAY, 'index': MATCH}, 'n_clicks'),
+        State({'type': C.INPUT_SLICE_DEPTH, 'index': MATCH}, 'className'),
+        prevent_initial_call=True
+    )
+
     app.clientside_callback(
         ClientsideFunction(namespace='clientside',
                            function_name='suppress_contextmenu'),
@@ -25,6 +70,14 @@ def make_clientside_callbacks(app):
         Output(C.STORE_CURRENT_TAB, 'data'), Input(C.STORE_CURRENT_TAB, 'data')
     )
 
+    app.clientside_callback(
+        ClientsideFunction(namespace='clientside',
+                           function_name='update_current_tab'),
+        Output(C.STORE_CURRENT_TAB, 'data', allow_duplicate=True),
+        Input({'type': 'tab-content-main', 'index': ALL}, 'className'),
+        prevent_initial_call=True
+    )
+
     app.clientside_callback(
         ClientsideFunction(namespace='clientside',
                            function_name='record_selected_slice'),
@@ -244,7 +244,7 @@ def make_slice_generation_container():
     return html.Div([
                     dcc.Store(id=C.STORE_GENERATE_SLICE),
                     dcc.Store(id=C.STORE_UPDATE_SLICE),
-                    dcc.Download(id=C.DOWNLOAD_IMAGE),
+                    dcc.Store(id=C.DOWNLOAD_IMAGE),  # url of the file to download
                     html.Div([
                         html.Div([
                             make_thresholds_container(
@@ -1106,7 +1106,7 @@ def make_3d_export_div():
             value=0,
             marks={i * 5: str(i * 5) for i in range(16)},
         ),
-        dcc.Download(id=C.DOWNLOAD_GLTF)
+        dcc.Store(id=C.DOWNLOAD_GLTF)  # url of the file to download
     ],
         className='general-border min-h-8 w-full flex-auto grow mb-2'
     )
@@ -2,10 +2,11 @@
 
 import shutil
 import threading
-import json
+import orjson
 import random
 import string
 import time
+import hashlib
 from PIL import Image
 from io import BytesIO
 from enum import Enum
@@ -16,7 +17,7 @@ from utils import (
     filename_previous_version, filename_add_version, apply_color_tint, create_checkerboard,
     encode_string_with_nonce, decode_string_with_nonce
 )
-from segmentation import mask_from_depth
+from segmentation import analyze_depth_histogram, mask_from_depth
 from upscaler import Upscaler
 from stabilityai import StabilityAI
 
@@ -36,21 +37,26 @@ class AppState:
         'selected_inpainting', 'result_tinted', 'grayscale_tinted', 'checkerboard',
         'slice_pixel', 'slice_pixel_depth', 'slice_mask', 'upscaler', 'clipboard_image',
         'use_checkerboard', 'multi_point_mode', 'points_selected', '_camera_position',
-        '_camera_distance', '_max_distance', '_focal_length', '_mesh_displacement'
+        '_camera_distance', '_max_distance', '_focal_length', '_mesh_displacement',
+        '_slice_url_cache', '_depth_map_preview',
+        '_img_array', '_composed_slices', '_input_image_url', '_depth_thresholds'
     )
     SRV_DIR = 'tmp-images'
     STATE_FILE = 'appstate.json'
     IMAGE_FILE = 'input_image.png'
     DEPTH_MAP_FILE = 'depth_map.png'
+    DEPTH_MAP_PREVIEW = 'depth_map_preview.webp'
     MAIN_IMAGE = 'main_image.bmp'
     MODEL_FILE = 'model.gltf'
     WORKFLOW = 'workflow.json'
+    MAX_COMPOSED_SLICES = 4
 
     cache = {}
+    _cache_lock = threading.Lock()  # serializes loading states that are not cached yet
 
     def __init__(self):
-        # prevent concurrent writes
-        self._lock = threading.Lock()
+        # prevent concurrent writes and slice list changes during a save
+        self._lock = threading.RLock()
 
         self.filename = None
         self.num_slices = 5
@@ -98,6 +104,13 @@ class AppState:
         self._focal_length = 100.0
         
         self._mesh_displacement = 0.0
+
+        self._slice_url_cache = {}  # slice index -> (slice filename, slice, served url)
+        self._depth_map_preview = None  # (depth map, served url) of the last preview
+        self._img_array = None  # (imgData, RGB numpy array) for the current input image
+        self._composed_slices = {}  # key -> (slice, imgData, composed image), least recently used first
+        self._input_image_url = None  # (imgData, served url) of the input image
+        self._depth_thresholds = None  # (depth map, {num_slices: thresholds}) from the histogram
         
     @property
     def mesh_displacement(self):
@@ -163,7 +176,8 @@ class AppState:
         # Prepare masks; make sure they are the right size and mode
         if not isinstance(mask, Image.Image):
             mask = Image.fromarray(mask)
-        mask = mask.convert('L')
+        if mask.mode != 'L':
+            mask = mask.convert('L')
 
         if image is not self.imgData:
             if not isinstance(image, Image.Image):
@@ -186,79 +200,100 @@ class AppState:
 
     def change_slice_depth(self, slice_index, depth):
         """Changes the depth of the slice at the specified index."""
-        assert slice_index >= 0 and slice_index < len(self.image_slices)
-
-        if depth == self.image_depths[slice_index]:
-            return slice_index
-
-        filename = self.image_slices_filenames[slice_index]
-        image = self.image_slices[slice_index]
-        positive_prompt = self.positive_prompts[slice_index]
-        negative_prompt = self.negative_prompts[slice_index]
-
-        # remove it from the lists
-        self.image_depths.pop(slice_index)
-        self.image_slices_filenames.pop(slice_index)
-        self.image_slices.pop(slice_index)
-        self.positive_prompts.pop(slice_index)
-        self.negative_prompts.pop(slice_index)
-
-        return self.add_slice(image, depth, filename=filename,
-                              positive_prompt=positive_prompt, negative_prompt=negative_prompt)
+        with self._lock:
+            assert slice_index >= 0 and slice_index < len(self.image_slices)
+
+            if depth == self.image_depths[slice_index]:
+                return slice_index
+
+            # the slice keeps its position if the new depth is still between its neighbors
+            lower_ok = slice_index == 0 or self.image_depths[slice_index - 1] < depth
+            upper_ok = slice_index == len(self.image_depths) - 1 or \
+                depth < self.image_depths[slice_index + 1]
+            if lower_ok and upper_ok:
+                self.image_depths[slice_index] = depth
+                return slice_index
+
+            filename = self.image_slices_filenames[slice_index]
+            image = self.image_slices[slice_index]
+            positive_prompt = self.positive_prompts[slice_index]
+            negative_prompt = self.negative_prompts[slice_index]
+
+            # remove it from the lists
+            self.image_depths.pop(slice_index)
+            self.image_slices_filenames.pop(slice_index)
+            self.image_slices.pop(slice_index)
+            self.positive_prompts.pop(slice_index)
+            self.negative_prompts.pop(slice_index)
+
+            return self.add_slice(image, depth, filename=filename,
+                                  positive_prompt=positive_prompt, negative_prompt=negative_prompt)
 
     def add_slice(self, slice_image, depth, filename=None, positive_prompt='', negative_prompt=''):
         """Adds the image as a new slice at the provided depth."""
-        if filename is None:
-            filename = str(Path(self.filename) /
-                           f"image_slice_{len(self.image_slices)}.png")
-        # find the index where the depth should be inserted
-        index = len(self.image_depths)
-        for i, d in enumerate(self.image_depths):
-            if depth < d:
-                index = i
-                break
-        self.image_depths.insert(index, depth)
-        self.image_slices_filenames.insert(index, filename)
-        self.image_slices.insert(index, slice_image)
-        self.positive_prompts.insert(index, positive_prompt)
-        self.negative_prompts.insert(index, negative_prompt)
-
-        if index > 0:
-            # make sure the depth values are all unique
-            for i in range(index, len(self.image_slices)):
-                if self.image_depths[i] == self.image_depths[i-1]:
-                    self.image_depths[i] += 1
-
-        return index
+        with self._lock:
+            if filename is None:
+                filename = str(Path(self.filename) /
+                               f"image_slice_{len(self.image_slices)}.png")
+            # find the index where the depth should be inserted
+            index = len(self.image_depths)
+            for i, d in enumerate(self.image_depths):
+                if depth < d:
+                    index = i
+                    break
+            self.image_depths.insert(index, depth)
+            self.image_slices_filenames.insert(index, filename)
+            self.image_slices.insert(index, slice_image)
+            self.positive_prompts.insert(index, positive_prompt)
+            self.negative_prompts.insert(index, negative_prompt)
+
+            if index > 0:
+                # make sure the depth values are all unique
+                for i in range(index, len(self.image_slices)):
+                    if self.image_depths[i] == self.image_depths[i-1]:
+                        self.image_depths[i] += 1
+
+            return index
 
     def delete_slice(self, slice_index):
         """Deletes the slice at the specified index."""
-        if slice_index < 0 or slice_index >= len(self.image_slices):
-            return False
-        self.image_slices.pop(slice_index)
-        self.image_depths.pop(slice_index)
-        self.image_slices_filenames.pop(slice_index)
-        self.positive_prompts.pop(slice_index)
-        self.negative_prompts.pop(slice_index)
-        self.selected_slice = None
-        self.slice_pixel = None
-        self.slice_pixel_depth = None
-        self.slice_mask = None
-
-        # XXX - decide whether to delete the corresponding files
-        return True
+        with self._lock:
+            if slice_index < 0 or slice_index >= len(self.image_slices):
+                return False
+            self.image_slices.pop(slice_index)
+            self.image_depths.pop(slice_index)
+            self.image_slices_filenames.pop(slice_index)
+            self.positive_prompts.pop(slice_index)
+            self.negative_prompts.pop(slice_index)
+            self.selected_slice = None
+            self.slice_pixel = None
+            self.slice_pixel_depth = None
+            self.slice_mask = None
+
+            # XXX - decide whether to delete the corresponding files
+            return True
 
     def reset_image_slices(self):
-        self.image_slices = []
-        self.image_depths = []
-        self.image_slices_filenames = []
-        self.positive_prompts = []
-        self.negative_prompts = []
-        self.selected_slice = None
-        self.selected_inpainting = None
-        self.slice_pixel = None
-        self.slice_mask = None
-        self.slice_pixel_depth = None
+        with self._lock:
+            self.image_slices = []
+            self.image_depths = []
+            self.image_slices_filenames = []
+            self.positive_prompts = []
+            self.negative_prompts = []
+            self.selected_slice = None
+            self.selected_inpainting = None
+            self.slice_pixel = None
+            self.slice_mask = None
+            self.slice_pixel_depth = None
+
+    def set_image_slices(self, image_slices, image_depths):
+        """Replaces all slices with newly generated ones that have no files or prompts yet."""
+        with self._lock:
+            self.image_slices = image_slices
+            self.image_depths = image_depths
+            self.image_slices_filenames = []
+            self.positive_prompts = ["" for _ in image_slices]
+            self.negative_prompts = ["" for _ in image_slices]
 
     def balance_slices_depths(self):
         """Equally distribute the depths of the image slices."""
@@ -266,6 +301,30 @@ class AppState:
         self.image_depths[1:] = [int(i * 255 / (self.num_slices - 1))
                                  for i in range(1, self.num_slices)]
 
+    def depth_thresholds(self, num_slices):
+        """Returns the thresholds from the depth map histogram for the number of slices.
+
+        The depth map is replaced rather than modified in place, so the thresholds are
+        cached per number of slices until depthMapData refers to a different array.
+        """
+        if self._depth_thresholds is None or self._depth_thresholds[0] is not self.depthMapData:
+            self._depth_thresholds = (self.depthMapData, {})
+        cached = self._depth_thresholds[1]
+        if num_slices not in cached:
+            cached[num_slices] = analyze_depth_histogram(
+                self.depthMapData, num_slices=num_slices)
+        # callers modify the thresholds in place
+        return list(cached[num_slices])
+
+    def threshold_slider_values(self):
+        """Returns the values of the user-adjustable threshold sliders.
+
+        The first and last thresholds are fixed, so there is one slider per slice boundary.
+        """
+        if self.imgThresholds is None:
+            return []
+        return [int(threshold) for threshold in self.imgThresholds[1:self.num_slices]]
+
     def depth_slice_from_pixel(self, pixel_x, pixel_y):
         depth = -1  # for log below
         if self.depthMapData is not None and self.imgThresholds is not None:
@@ -281,6 +340,22 @@ class AppState:
 
         return mask, depth
 
+    def img_array(self):
+        """Returns the input image as a read-only RGB numpy array.
+
+        The array is cached until imgData is replaced, so callbacks can use the
+        pixels without converting the PIL image on every call.
+        """
+        cached = self._img_array
+        if cached is None or cached[0] is not self.imgData:
+            image = self.imgData
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            array = np.asarray(image)
+            array.flags.writeable = False
+            cached = self._img_array = (self.imgData, array)
+        return cached[1]
+
     def set_img_data(self, img_data):
         self.imgData = img_data.convert('RGB')
         self.depthMapData = None
@@ -298,17 +373,33 @@ class AppState:
         return f'/{str(model_path)}?v={unique_id}'
 
     def serve_slice_image(self, slice_index):
-        """Serves the image slice with the specified index."""
+        """Serves the image slice with the specified index.
+
+        Slices are replaced rather than modified in place, but regenerated slices may reuse
+        the same filename. The served url is therefore cached per slice index until the
+        slice refers to a different array or filename, which also rewrites the checkerboard file.
+        """
         assert slice_index >= 0 and slice_index < len(
             self.image_slices_filenames)
+        filename = self.image_slices_filenames[slice_index]
+        slice_image = self.image_slices[slice_index]
+        cached = self._slice_url_cache.get(slice_index)
+        # holding the slice in the cache keeps its id from being reused
+        if cached is not None and cached[0] == filename and cached[1] is slice_image:
+            return cached[2]
+
         image_path = self.checkerboard_filename(slice_index)
-        if not image_path.exists():
-            image = self.slice_image_composed(
-                slice_index, mode=CompositeMode.CHECKERBOARD)
-            image.save(image_path)
+        image = self.slice_image_composed(
+            slice_index, mode=CompositeMode.CHECKERBOARD)
+        image.save(image_path)
         image_path = Path(self.SRV_DIR) / image_path
-        unique_id = int(time.time())
-        return f'/{str(image_path)}?v={unique_id}'
+        unique_id = time.time_ns()
+        url = f'/{str(image_path)}?v={unique_id}'
+        # drop the urls of slices that no longer exist
+        for index in [i for i in self._slice_url_cache if i >= len(self.image_slices_filenames)]:
+            del self._slice_url_cache[index]
+        self._slice_url_cache[slice_index] = (filename, slice_image, url)
+        return url
 
     def slice_image_composed(self, slice_index, mode: CompositeMode = CompositeMode.NONE):
         """Composes the slice image over the main image."""
@@ -325,29 +416,54 @@ class AppState:
             composite = self.grayscale_tinted
         elif mode == CompositeMode.CHECKERBOARD:
             if self.checkerboard is None:
-                self.checkerboard = create_checkerboard(
-                    slice_image.size[1], slice_image.size[0], 32)
-            composite = Image.fromarray(self.checkerboard)
+                self.checkerboard = Image.fromarray(create_checkerboard(
+                    slice_image.size[1], slice_image.size[0], 32))
+            composite = self.checkerboard
 
         full_image = Image.composite(
             slice_image, composite, slice_image.getchannel('A'))
         return full_image
 
     def serve_slice_image_composed(self, slice_index, mode: CompositeMode):
-        """Serves the slice image composed over the gray main image."""
-        full_image = self.slice_image_composed(slice_index, mode=mode)
+        """Serves the slice image composed over the gray main image.
+
+        The composed images of the most recently served slices are kept, so switching
+        between them does not compose them again. Modified slices get a new versioned
+        filename, which invalidates the cached image.
+        """
+        key = (slice_index, self.image_slices_filenames[slice_index], mode)
+        slice_image = self.image_slices[slice_index]
+        cached = self._composed_slices.pop(key, None)
+        # compare the images by identity; holding them in the cache keeps their ids from being reused
+        if cached is not None and cached[0] is slice_image and cached[1] is self.imgData:
+            full_image = cached[2]
+        else:
+            full_image = self.slice_image_composed(slice_index, mode=mode)
+            if len(self._composed_slices) >= self.MAX_COMPOSED_SLICES:
+                self._composed_slices.pop(next(iter(self._composed_slices)))
+        self._composed_slices[key] = (slice_image, self.imgData, full_image)
         return self.serve_main_image(full_image)
 
     def serve_input_image(self):
-        """Serves the input image from the state directory."""
+        """Serves the input image from the state directory.
+
+        The url stays the same while imgData is unchanged, so the browser can reuse
+        its cached copy when switching back to the input image.
+        """
         filename = Path(self.filename) / self.IMAGE_FILE
+        if self._input_image_url is not None:
+            img_data, url = self._input_image_url
+            if img_data is self.imgData and filename.exists():
+                return url
         if not filename.exists():
             if not Path(self.filename).exists():
                 Path(self.filename).mkdir()
             self.imgData.save(filename, compress_level=1)
         filename = Path(self.SRV_DIR) / filename
-        unique_id = int(time.time())
-        return f'/{str(filename)}?v={unique_id}'
+        unique_id = time.time_ns()
+        url = f'/{str(filename)}?v={unique_id}'
+        self._input_image_url = (self.imgData, url)
+        return url
 
     def serve_main_image(self, image):
         """Serves the image using a temporary directory."""
@@ -356,12 +472,37 @@ class AppState:
         output_dir = Path(self.filename)
         if not output_dir.exists():
             output_dir.mkdir()
-        save_path = Path(self.filename) / self.MAIN_IMAGE
+        save_path = output_dir / self.MAIN_IMAGE
         image.save(save_path)
         image_path = Path(self.SRV_DIR) / save_path
-        unique_id = int(time.time())
+        # the served images rarely repeat, so hashing the frame would cost more than the write
+        unique_id = time.time_ns()
         return f'/{str(image_path)}?v={unique_id}'
 
+    def serve_depth_map(self):
+        """Serves a lossy preview of the depth map using the state directory.
+
+        The depth map is replaced rather than modified in place, so the preview
+        is only encoded again when depthMapData refers to a different array.
+        """
+        output_dir = Path(self.filename)
+        save_path = output_dir / self.DEPTH_MAP_PREVIEW
+        if self._depth_map_preview is not None:
+            depth_map, url = self._depth_map_preview
+            if depth_map is self.depthMapData and save_path.exists():
+                return url
+
+        if not output_dir.exists():
+            output_dir.mkdir()
+        # method=0 is the fastest WebP encoder setting; the preview is only for display
+        Image.fromarray(self.depthMapData).save(save_path, quality=85, method=0)
+        image_path = Path(self.SRV_DIR) / save_path
+        unique_id = hashlib.blake2b(self.depthMapData.tobytes(), digest_size=8).hexdigest()
+        url = f'/{str(image_path)}?v={unique_id}'
+        # keeping a reference to the array prevents its id from being reused
+        self._depth_map_preview = (self.depthMapData, url)
+        return url
+
     def workflow_path(self):
         """Returns the workflow path."""
         return Path(self.filename) / self.WORKFLOW
@@ -466,12 +607,13 @@ class AppState:
         self.image_slices[slice_index] = self._read_image_slice(slice_index)
         return True
 
-    def save_image_slice(self, slice_index):
+    def save_image_slice(self, slice_index, compress_level=None):
         """
         Save the image slice with the specified index.
 
         Args:
             slice_index (int): The index of the slice to save.
+            compress_level (int, optional): The PNG compression level. Defaults to PIL's default.
         """
         assert slice_index >= 0 and slice_index < len(
             self.image_slices_filenames)
@@ -480,7 +622,10 @@ class AppState:
             slice_image = Image.fromarray(slice_image, mode='RGBA')
         output_image_path = self.image_slices_filenames[slice_index]
         print(f"Saving image slice: {output_image_path}")
-        slice_image.save(str(output_image_path))
+        if compress_level is None:
+            slice_image.save(str(output_image_path))
+        else:
+            slice_image.save(str(output_image_path), compress_level=compress_level)
 
     def save_image_slices(self, file_path):
         """
@@ -640,10 +785,15 @@ class AppState:
         Returns:
             AppState: The loaded state.
         """
-        if file_path in AppState.cache:
-            return AppState.cache[file_path]
-        state = AppState.from_file(file_path)
-        AppState.cache[file_path] = state
+        state = AppState.cache.get(file_path)
+        if state is not None:
+            return state
+        # concurrent callbacks for the same state must share one instance loaded from disk once
+        with AppState._cache_lock:
+            state = AppState.cache.get(file_path)
+            if state is None:
+                state = AppState.from_file(file_path)
+                AppState.cache[file_path] = state
         return state
 
     @staticmethod
@@ -707,7 +857,8 @@ class AppState:
         if self.api_key is not None:
             data['api_key'] = encode_string_with_nonce(
                 self.api_key, self.filename)
-        return json.dumps(data)
+        # numpy scalars can end up in the thresholds and depths
+        return orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY).decode('utf-8')
 
     @staticmethod
     def from_json(json_data):
@@ -715,7 +866,7 @@ class AppState:
         Load the state from a JSON string.
 
         Args:
-            json_data (str): The JSON string representation of the state.
+            json_data (str or bytes): The JSON representation of the state.
 
         Returns:
             AppState: The loaded state.
@@ -724,7 +875,7 @@ class AppState:
         if json_data is None:
             return state
 
-        data = json.loads(json_data)
+        data = orjson.loads(json_data)
 
         state.filename = data['filename']
         state.num_slices = data['num_slices'] if 'num_slices' in data else 5
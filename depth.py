@@ -17,7 +17,12 @@ import cv2
 import numpy as np
 from PIL import Image
 
-from utils import torch_get_device
+from utils import torch_get_device, torch_autocast, torch_to_device
+
+# the most recently loaded pipeline - shared by all model instances so that
+# creating a new DepthEstimationModel does not reload the weights
+_pipeline_cache = {}
+
 
 class DepthEstimationModel:
     MODELS = ["midas", "zoedepth", "dinov2"]
@@ -45,7 +50,11 @@ class DepthEstimationModel:
             "dinov2": create_dinov2_pipeline
         }
         
-        result = load_pipeline[self._model_name](progress_callback=progress_callback)
+        result = _pipeline_cache.get(self._model_name)
+        if result is None:
+            result = load_pipeline[self._model_name](progress_callback=progress_callback)
+            _pipeline_cache.clear()
+            _pipeline_cache[self._model_name] = result
 
         if self._model_name == "midas":
             self.model, self.transforms = result
@@ -65,6 +74,29 @@ class DepthEstimationModel:
         }
 
         return run_pipeline[self._model_name](image, progress_callback)
+
+    def depth_maps(self, images, progress_callback=None):
+        """
+        Computes the depth maps for a list of images.
+
+        MiDaS runs all images of the same size in a single forward pass; the
+        other models process the images one at a time.
+
+        Args:
+            images (list): The input images as numpy arrays.
+            progress_callback (callable, optional): A callback function to report progress.
+
+        Returns:
+            list: The depth maps in the same order as the input images.
+        """
+        if self.model is None:
+            self.load_model()
+
+        if self._model_name == "midas" and len({image.shape for image in images}) == 1:
+            return run_medias_pipeline_batch(
+                images, self.model, self.transforms, progress_callback=progress_callback)
+
+        return [self.depth_map(image, progress_callback=progress_callback) for image in images]
     
     
 def create_dinov2_pipeline(progress_callback=None):
@@ -89,7 +121,7 @@ def run_dinov2_pipeline(image, model, image_processor, progress_callback=None):
     resized_image = image.convert("RGB").resize(new_size, Image.BICUBIC)
     inputs = image_processor(images=resized_image, return_tensors="pt")
     inputs = {k: v.to(torch_get_device()) for k, v in inputs.items()}
-    with torch.no_grad():
+    with torch.inference_mode():
         outputs = model(**inputs)
         predicted_depth = outputs.predicted_depth
 
@@ -162,12 +194,12 @@ def run_medias_pipeline(image, midas, transforms, progress_callback=None):
     Returns:
         numpy.ndarray: The predicted segmentation mask.
     """
-    input_batch = transforms(image).to(torch_get_device())
-    with torch.no_grad():
+    input_batch = torch_to_device(transforms(image))
+    with torch.inference_mode(), torch_autocast():
         prediction = midas(input_batch)
 
         prediction = torch.nn.functional.interpolate(
-            prediction.unsqueeze(1),
+            prediction.unsqueeze(1).float(),
             size=image.shape[:2],
             mode="bicubic",
             align_corners=False,
@@ -179,6 +211,36 @@ def run_medias_pipeline(image, midas, transforms, progress_callback=None):
     return prediction.cpu().numpy()
 
 
+def run_medias_pipeline_batch(images, midas, transforms, progress_callback=None):
+    """
+    Runs the media pipeline on a batch of images of the same size.
+
+    Args:
+        images (list): The input images as numpy arrays.
+        midas (torch.nn.Module): The MIDAS model.
+        transforms (torchvision.transforms.Compose): The image transforms.
+        progress_callback (callable, optional): A callback function to report progress.
+
+    Returns:
+        list: The predicted depth maps as numpy arrays.
+    """
+    input_batch = torch_to_device(torch.cat([transforms(image) for image in images]))
+    with torch.inference_mode(), torch_autocast():
+        prediction = midas(input_batch)
+
+        prediction = torch.nn.functional.interpolate(
+            prediction.unsqueeze(1).float(),
+            size=images[0].shape[:2],
+            mode="bicubic",
+            align_corners=False,
+        ).squeeze(1)
+
+    if progress_callback:
+        progress_callback(90, 100)
+
+    return list(prediction.cpu().numpy())
+
+
 def midas_depth_map(image, progress_callback=None):
     if progress_callback:
         progress_callback(0, 100)
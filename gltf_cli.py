@@ -12,41 +12,44 @@ import numpy as np
 
 from controller import AppState
 from webui import export_state_as_gltf
-from segmentation import generate_depth_map
+from segmentation import generate_slice_depth_maps
 from utils import postprocess_depth_map
 from depth import DepthEstimationModel
 
 
-def compute_depth_map_for_slices(state: AppState, postprocess: bool = True):
-    depth_maps = []
-    
-    model_name = state.depth_model_name if state.depth_model_name else 'midas'
-    model = DepthEstimationModel(model=model_name)
-    for i, filename in enumerate(state.image_slices_filenames):
-        print(f"Processing {filename}")
+def _save_slice_depth_map(state: AppState, i: int, filename: str, image, depth_map, postprocess: bool):
+    tmp_filename = state._make_filename(i, 'depth_tmp')
+    depth_image = Image.fromarray(depth_map)
+    # intermediate depth maps are only read back locally, so skip deflate
+    depth_image.save(tmp_filename, compress_level=0)
+
+    if postprocess:
+        image_alpha = image[:, :, 3]
+        depth_map = postprocess_depth_map(depth_map, image_alpha, final_blur=50)
 
-        image = state.image_slices[i]
+    depth_image = Image.fromarray(depth_map)
 
-        depth_map = generate_depth_map(image[:, :, :3], model)
-        
-        tmp_filename = state._make_filename(i, 'depth_tmp')
-        depth_image = Image.fromarray(depth_map)
-        depth_image.save(tmp_filename, compress_level=9)
+    output_filename = Path(state.filename) / \
+        (Path(filename).stem + "_depth.png")
 
-        if postprocess:
-            image_alpha = image[:, :, 3]
-            depth_map = postprocess_depth_map(depth_map, image_alpha, final_blur=50)
+    depth_image.save(output_filename, compress_level=0)
+    print(f"Saved depth map to {output_filename}")
 
-        depth_image = Image.fromarray(depth_map)
+    return output_filename
 
-        output_filename = Path(state.filename) / \
-            (Path(filename).stem + "_depth.png")
 
-        depth_image.save(output_filename, compress_level=1)
-        print(f"Saved depth map to {output_filename}")
+def compute_depth_map_for_slices(state: AppState, postprocess: bool = True, batch_size: int = 4):
+    model_name = state.depth_model_name if state.depth_model_name else 'midas'
+    model = DepthEstimationModel(model=model_name)
+
+    def save_depth_map(i, depth_map):
+        return _save_slice_depth_map(
+            state, i, state.image_slices_filenames[i], state.image_slices[i],
+            depth_map, postprocess)
 
-        depth_maps.append(output_filename)
-    return depth_maps
+    return generate_slice_depth_maps(
+        state.image_slices, range(len(state.image_slices_filenames)), model,
+        save_depth_map, batch_size=batch_size, max_workers=os.cpu_count())
 
 
 def main():
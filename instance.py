@@ -12,6 +12,7 @@ Todo:
  - Create support for HQ-SAM: https://github.com/SysCV/sam-hq?tab=readme-ov-file
 '''
 
+import hashlib
 from PIL import Image
 import torch
 from transformers import AutoImageProcessor, Mask2FormerForUniversalSegmentation, SamModel, SamProcessor
@@ -22,7 +23,9 @@ from utils import torch_get_device, image_overlay, draw_circle
 
 class SegmentationModel:
     MODELS = ["mask2former", "sam"]
-    
+    # one embedding for each of the transformations used by mask_at_point_blended
+    MAX_CACHED_EMBEDDINGS = 6
+
     def __init__(self, model="sam"):
         assert model in self.MODELS
         self.model_name = model
@@ -30,6 +33,7 @@ class SegmentationModel:
         self.image_processor = None
         self.image = None
         self.mask = None
+        self._image_embeddings = {}  # image digest -> SAM image embeddings
 
     def __eq__(self, other):
         if not isinstance(other, SegmentationModel):
@@ -212,8 +216,11 @@ class SegmentationModel:
         # convert inputs to dtype torch.float32
         inputs = inputs.to(torch.float32).to(self.model.device)
 
-        with torch.no_grad():
-            outputs = self.model(**inputs)
+        image_embeddings = self._sam_image_embeddings(inputs["pixel_values"])
+        with torch.inference_mode():
+            outputs = self.model(image_embeddings=image_embeddings,
+                                 input_points=inputs["input_points"],
+                                 input_labels=inputs["input_labels"])
 
         # the model is capabale of returning multiple masks, but we only return one for now
         masks = self.image_processor.image_processor.post_process_masks(
@@ -241,6 +248,23 @@ class SegmentationModel:
         
         return mask_image
 
+    def _sam_image_embeddings(self, pixel_values):
+        """
+        Returns the SAM image embeddings for the current image.
+
+        The vision encoder dominates the cost of a SAM prediction, so the embeddings are
+        cached by the content of the image and reused for subsequent clicks on the same image.
+        """
+        key = hashlib.blake2b(self.image.tobytes(), digest_size=16).digest()
+        image_embeddings = self._image_embeddings.get(key)
+        if image_embeddings is None:
+            with torch.inference_mode():
+                image_embeddings = self.model.get_image_embeddings(pixel_values)
+            if len(self._image_embeddings) >= self.MAX_CACHED_EMBEDDINGS:
+                self._image_embeddings.pop(next(iter(self._image_embeddings)))
+            self._image_embeddings[key] = image_embeddings
+        return image_embeddings
+
     # Function to rotate point around the image center for specific angles
     @staticmethod
     def _rotate_point(point, angle, image_size):
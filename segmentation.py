@@ -6,10 +6,13 @@
 #
 
 import cv2
+import numba as nb
 import numpy as np
 import torch
 from torchvision.transforms import Compose
 import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from PIL import Image
 
@@ -41,24 +44,85 @@ def generate_depth_map(image, model: DepthEstimationModel, progress_callback=Non
     return depth_map
 
 
+def generate_depth_maps(images, model: DepthEstimationModel, progress_callback=None):
+    """
+    Generate depth maps for a list of images, batching the inference where the model supports it.
+
+    Args:
+        images (list): The input images as numpy arrays.
+        model (DepthEstimationModel): The depth estimation model to use.
+        progress_callback (callable, optional): A callback function to report progress.
+
+    Returns:
+        list: The grayscale depth maps in the same order as the input images.
+    """
+    depth_maps = model.depth_maps(images, progress_callback=progress_callback)
+    return [cv2.normalize(depth_map, None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U)
+            for depth_map in depth_maps]
+
+
+def generate_slice_depth_maps(image_slices, indices, model: DepthEstimationModel, save_depth_map,
+                              batch_size=4, max_workers=2):
+    """
+    Generate and save depth maps for the selected image slices.
+
+    The slices are run through the model in batches, while save_depth_map post-processes
+    and saves the depth maps of the previous batch on a thread pool.
+
+    Args:
+        image_slices (list): The RGBA image slices as numpy arrays.
+        indices (list): The indices of the slices that need a depth map.
+        model (DepthEstimationModel): The depth estimation model to use.
+        save_depth_map (callable): Called as save_depth_map(index, depth_map) for each slice.
+        batch_size (int, optional): The number of slices per forward pass. Defaults to 4.
+        max_workers (int, optional): The number of threads saving depth maps. Defaults to 2.
+
+    Returns:
+        list: The results of save_depth_map in the order of indices.
+    """
+    indices = list(indices)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = []
+        for start in range(0, len(indices), batch_size):
+            batch = indices[start:start + batch_size]
+            print(f"Generating depth maps for slices {batch}")
+            depth_maps = generate_depth_maps(
+                [image_slices[i][:, :, :3] for i in batch], model=model)
+            futures.extend(executor.submit(save_depth_map, i, depth_map)
+                           for i, depth_map in zip(batch, depth_maps))
+        # surface any errors from saving the depth maps
+        return [future.result() for future in futures]
+
+
 def analyze_depth_histogram(depth_map, num_slices=5):
     """Analyze the histogram of the depth map and determine thresholds for segmentation."""
-    def calculate_thresholds(depth_map, num_slices):
+    def calculate_thresholds(cumulative, num_slices):
         thresholds = [0]
-        hist, _ = np.histogram(depth_map.flatten(), 256, [0, 256])
         total_pixels = depth_map.shape[0] * depth_map.shape[1]
         target_pixels_per_slice = float(total_pixels) / (num_slices+1)
-        total_sum = 0
-        for i in range(1, 256):
-            total_sum += hist[i]
-            if total_sum >= target_pixels_per_slice*len(thresholds) or i == 255:
-                thresholds.append(i)
-        return thresholds
+        # each threshold is the first depth after the previous threshold at
+        # which the cumulative pixel count reaches the next target
+        i = 1
+        while True:
+            i = max(i, int(np.searchsorted(
+                cumulative, target_pixels_per_slice*len(thresholds))) + 1)
+            if i >= 255:
+                thresholds.append(255)
+                return thresholds
+            thresholds.append(i)
+            i += 1
+
+    if depth_map.dtype == np.uint8:
+        hist = np.bincount(depth_map.ravel(), minlength=256)
+    else:
+        hist, _ = np.histogram(depth_map.ravel(), 256, [0, 256])
+    # pixels at depth 0 are not counted towards any slice
+    cumulative = np.cumsum(hist[1:])
 
     # this is a terrible hack to make sure we get the right number of thresholds
-    thresholds = calculate_thresholds(depth_map, num_slices - 1)
+    thresholds = calculate_thresholds(cumulative, num_slices - 1)
     if (len(thresholds) != num_slices + 1):
-        thresholds = calculate_thresholds(depth_map, num_slices)
+        thresholds = calculate_thresholds(cumulative, num_slices)
     assert len(thresholds) == num_slices + \
         1, f"Expected {num_slices + 1} thresholds, got {len(thresholds)}"
     return thresholds
@@ -165,25 +229,22 @@ def setup_camera_and_cards(image_slices, depths, camera_distance=100.0, max_dist
                               [0, focal_length_px, image_height / 2],
                               [0, 0, 1]], dtype=np.float32)
 
-    # Set up the card corners in 3D space
-    card_corners_3d_list = []
+    # Set up the card corners in 3D space for all slices at once
     # The thresholds start with 0 and end with 255. We want the closest card to be at 0.
-    for i in range(num_slices):
-        z = max_distance * ((255 - depths[i]) / 255.0)
+    z = max_distance * ((255 - np.asarray(depths[:num_slices])) / 255.0)
 
-        # Calculate the 3D points of the card corners
-        card_width = (image_width * (z + camera_distance)) / focal_length_px
-        card_height = (image_height * (z + camera_distance)) / focal_length_px
+    # Calculate the 3D points of the card corners
+    half_width = (image_width * (z + camera_distance)) / focal_length_px / 2
+    half_height = (image_height * (z + camera_distance)) / focal_length_px / 2
 
-        card_corners_3d = np.array([
-            [-card_width / 2, -card_height / 2, z],
-            [card_width / 2, -card_height / 2, z],
-            [card_width / 2, card_height / 2, z],
-            [-card_width / 2, card_height / 2, z]
-        ], dtype=np.float32)
-        card_corners_3d_list.append(card_corners_3d)
+    card_corners_3d = np.stack([
+        np.stack([-half_width, -half_height, z], axis=1),
+        np.stack([half_width, -half_height, z], axis=1),
+        np.stack([half_width, half_height, z], axis=1),
+        np.stack([-half_width, half_height, z], axis=1)
+    ], axis=1).astype(np.float32)
 
-    return camera_matrix, card_corners_3d_list
+    return camera_matrix, list(card_corners_3d)
 
 
 def render_view(image_slices, camera_matrix, card_corners_3d_list, camera_position):
@@ -240,7 +301,10 @@ def remove_mask_from_alpha(image, mask):
     """
     assert image.shape[2] == 4, "Image must have an alpha channel"
     assert image.shape[:2] == mask.shape, f"Image and mask must have the same dimensions: {image.shape[:2]} vs {mask.shape}"
-    
+
+    if image.dtype == np.uint8 and mask.dtype == np.uint8:
+        return _remove_mask_from_alpha_uint8(image, mask)
+
     inverted_mask = 1 - mask/255.0
     slice_mask = image[:, :, 3] / 255.0
 
@@ -250,6 +314,44 @@ def remove_mask_from_alpha(image, mask):
     
     return final_mask
 
+
+@nb.jit(nopython=True, cache=True)
+def _remove_mask_from_alpha_uint8(image, mask):
+    """
+    Computes the alpha channel of remove_mask_from_alpha in one pass without temporaries.
+
+    Uses the same float64 expressions as remove_mask_from_alpha, so the results are identical.
+    Serial for the same reason as _blend_with_alpha_uint8.
+    """
+    height, width = mask.shape
+    final_mask = np.empty((height, width), dtype=np.uint8)
+    for y in range(height):
+        for x in range(width):
+            final_mask[y, x] = np.uint8(
+                (1 - mask[y, x] / 255.0) * (image[y, x, 3] / 255.0) * 255)
+    return final_mask
+
+
+@nb.jit(nopython=True, nogil=True, cache=True)
+def _blend_with_alpha_uint8(target_image, merge_image):
+    """
+    Blends two uint8 RGBA images of the same size in a single pass without temporaries.
+
+    Computes the same float64 expressions as blend_with_alpha, so the results are identical.
+    The kernel is deliberately serial: it is called from concurrent Dash callbacks and
+    render threads, and numba's workqueue threading layer aborts on concurrent parallel regions.
+    """
+    height, width = target_image.shape[:2]
+    for y in range(height):
+        for x in range(width):
+            alpha = merge_image[y, x, 3] / 255.0
+            for c in range(3):
+                target_image[y, x, c] = np.uint8(
+                    (1 - alpha) * target_image[y, x, c] + alpha * merge_image[y, x, c])
+            if merge_image[y, x, 3] > target_image[y, x, 3]:
+                target_image[y, x, 3] = merge_image[y, x, 3]
+
+
 def blend_with_alpha(target_image, merge_image):
     """
     Blends the merge_image with the target_image using alpha blending.
@@ -261,13 +363,21 @@ def blend_with_alpha(target_image, merge_image):
     Returns:
     None
     """
+    if target_image.dtype == np.uint8 and merge_image.dtype == np.uint8 and \
+            target_image.shape == merge_image.shape:
+        _blend_with_alpha_uint8(target_image, merge_image)
+        return
+
     alpha = merge_image[:, :, 3] / 255.0
-    target_image[:, :, 0] = (
-        1 - alpha) * target_image[:, :, 0] + alpha * merge_image[:, :, 0]
-    target_image[:, :, 1] = (
-        1 - alpha) * target_image[:, :, 1] + alpha * merge_image[:, :, 1]
-    target_image[:, :, 2] = (
-        1 - alpha) * target_image[:, :, 2] + alpha * merge_image[:, :, 2]
+    inverse_alpha = 1 - alpha
+    # reuse two scratch planes for all channels instead of allocating per operation
+    blended = np.empty_like(alpha)
+    merged = np.empty_like(alpha)
+    for channel in range(3):
+        np.multiply(inverse_alpha, target_image[:, :, channel], out=blended)
+        np.multiply(alpha, merge_image[:, :, channel], out=merged)
+        blended += merged
+        target_image[:, :, channel] = blended
     target_image[:, :, 3] = np.maximum(
         target_image[:, :, 3], merge_image[:, :, 3])
 
@@ -298,13 +408,16 @@ def render_image_sequence(output_path,
         progress_callback(0, num_frames)
 
     output_path = Path(output_path)
-    for i in range(num_frames):
-        # Update the camera position
+
+    # precompute the camera trajectory so that frames can be rendered independently
+    camera_positions = []
+    for _ in range(num_frames):
         camera_position[2] += float(push_distance)/num_frames
+        camera_positions.append(camera_position.copy())
 
-        # Render the view
+    def render_frame(i):
         rendered_image = render_view(
-            image_slices, camera_matrix, card_corners_3d_list, camera_position)
+            image_slices, camera_matrix, card_corners_3d_list, camera_positions[i])
 
         image_name = f'rendered_image_{i:03d}.png'
         output_image_path = output_path / image_name
@@ -312,8 +425,12 @@ def render_image_sequence(output_path,
         cv2.imwrite(str(output_image_path), cv2.cvtColor(
             rendered_image, cv2.COLOR_RGBA2BGR))
 
-        if progress_callback:
-            progress_callback(i+1, num_frames)
+    # opencv and the numba blending kernel release the GIL, so threads can share the slices;
+    # the blending kernel is serial, so the frames never start nested numba parallel regions
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for i, _ in enumerate(executor.map(render_frame, range(num_frames))):
+            if progress_callback:
+                progress_callback(i+1, num_frames)
 
 
 def process_image(image_path, output_path, num_slices=5,
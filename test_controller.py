@@ -1,10 +1,13 @@
 import numpy as np
+import os
 import unittest
+import tempfile
 from unittest.mock import mock_open, patch, MagicMock
 from pathlib import Path
+from PIL import Image
 
 from utils import encode_string_with_nonce, decode_string_with_nonce
-from controller import AppState
+from controller import AppState, CompositeMode
 
 
 class TestAddSlice(unittest.TestCase):
@@ -158,6 +161,18 @@ class TestChangeSliceDepth(unittest.TestCase):
         self.assertEqual(self.state.image_slices, initial_slices)
         self.assertEqual(self.state.image_depths, initial_depths)
 
+    def test_change_slice_depth_between_neighbors(self):
+        initial_slices = self.state.image_slices.copy()
+        initial_filenames = self.state.image_slices_filenames.copy()
+
+        new_index = self.state.change_slice_depth(1, 12)
+
+        self.assertEqual(new_index, 1)
+        self.assertEqual(self.state.image_depths, [5, 12, 15])
+        self.assertEqual(self.state.image_slices, initial_slices)
+        self.assertEqual(self.state.image_slices_filenames, initial_filenames)
+        self.assertEqual(self.state.positive_prompts, ["one", "three", "blue"])
+
     def test_change_slice_depth_valid(self):
         # Get the initial state
         initial_slices = self.state.image_slices.copy()
@@ -294,6 +309,20 @@ class TestFromJson(unittest.TestCase):
         self.assertEqual(state.server_address, None)
         self.assertEqual(state.api_key, None)
 
+    def test_to_json_round_trip_with_numpy_values(self):
+        state = AppState()
+        state.filename = 'appstate-test'
+        state.imgThresholds = [0, np.int64(100), 255]
+        state.image_depths = [np.int64(100), 255]
+        state.image_slices_filenames = ['appstate-test/image1.png', 'appstate-test/image2.png']
+        state.positive_prompts = ['one fish', 'two fish']
+        state.negative_prompts = ['', '']
+
+        restored = AppState.from_json(state.to_json())
+        self.assertEqual(restored.imgThresholds, [0, 100, 255])
+        self.assertEqual(restored.image_depths, [100, 255])
+        self.assertEqual(restored.positive_prompts, ['one fish', 'two fish'])
+
 
 class TestUpscaling(unittest.TestCase):
     def setUp(self):
@@ -370,6 +399,222 @@ class TestSaveImageSlices(unittest.TestCase):
             mock_imwrite.assert_any_call('appstate-random/image_slice_2.png')
 
 
+class StateDirectoryTestCase(unittest.TestCase):
+    """Runs each test in a temporary working directory with a fresh AppState."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp_dir.name)
+        self.state = AppState()
+        self.state.filename = 'appstate-random'
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp_dir.cleanup()
+
+
+class TestServeDepthMap(StateDirectoryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.state.depthMapData = np.arange(100, dtype=np.uint8).reshape(10, 10)
+
+    def test_serve_depth_map(self):
+        url = self.state.serve_depth_map()
+
+        preview = Path(self.state.filename) / AppState.DEPTH_MAP_PREVIEW
+        self.assertTrue(preview.exists())
+        self.assertTrue(url.startswith(f'/{AppState.SRV_DIR}/{preview}?v='))
+
+    def test_serve_depth_map_changes_url_with_content(self):
+        url = self.state.serve_depth_map()
+        self.assertEqual(url, self.state.serve_depth_map())
+
+        self.state.depthMapData = 255 - self.state.depthMapData
+        self.assertNotEqual(url, self.state.serve_depth_map())
+
+    def test_serve_depth_map_skips_unchanged_depth_map(self):
+        url = self.state.serve_depth_map()
+
+        with patch('controller.Image.Image.save') as mock_save:
+            self.assertEqual(url, self.state.serve_depth_map())
+            mock_save.assert_not_called()
+
+
+class TestServeMainImage(StateDirectoryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.image = np.zeros((10, 10, 3), dtype=np.uint8)
+
+    def test_serve_main_image_writes_every_image(self):
+        url = self.state.serve_main_image(self.image)
+        self.assertTrue((Path(self.state.filename) / AppState.MAIN_IMAGE).exists())
+        self.assertTrue(url.startswith(f'/{AppState.SRV_DIR}/appstate-random/{AppState.MAIN_IMAGE}?v='))
+
+        with patch('controller.Image.Image.save') as mock_save:
+            self.assertNotEqual(url, self.state.serve_main_image(self.image.copy()))
+            mock_save.assert_called_once()
+
+
+class TestServeInputImage(StateDirectoryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.state.imgData = Image.new('RGB', (10, 10))
+
+    def test_serve_input_image_url_stable_until_image_changes(self):
+        url = self.state.serve_input_image()
+        self.assertTrue((Path(self.state.filename) / AppState.IMAGE_FILE).exists())
+        self.assertEqual(url, self.state.serve_input_image())
+
+        self.state.imgData = Image.new('RGB', (10, 10), (1, 2, 3))
+        self.assertNotEqual(url, self.state.serve_input_image())
+
+
+class TestServeSliceImage(StateDirectoryTestCase):
+    def setUp(self):
+        super().setUp()
+        os.mkdir(self.state.filename)
+        self.state.image_slices = [np.zeros((10, 10, 4), dtype=np.uint8)]
+        self.state.image_slices_filenames = ['appstate-random/image_slice_0.png']
+
+    def test_serve_slice_image_cached_until_slice_changes(self):
+        url = self.state.serve_slice_image(0)
+        self.assertTrue(Path('appstate-random/image_slice_0_checkerboard.png').exists())
+
+        with patch('controller.Image.Image.save') as mock_save:
+            self.assertEqual(url, self.state.serve_slice_image(0))
+            mock_save.assert_not_called()
+
+            # regenerated slices reuse the filename but are new arrays
+            self.state.image_slices[0] = np.full((10, 10, 4), 255, dtype=np.uint8)
+            self.assertNotEqual(url, self.state.serve_slice_image(0))
+            mock_save.assert_called_once()
+
+    def test_serve_slice_image_rewrites_checkerboard_for_new_slice(self):
+        self.state.serve_slice_image(0)
+        self.state.image_slices[0] = np.full((10, 10, 4), 255, dtype=np.uint8)
+        self.state.serve_slice_image(0)
+
+        checkerboard = np.array(Image.open('appstate-random/image_slice_0_checkerboard.png'))
+        self.assertTrue(np.all(checkerboard == 255))
+
+    def test_serve_slice_image_new_filename(self):
+        url = self.state.serve_slice_image(0)
+        self.state.image_slices_filenames[0] = 'appstate-random/image_slice_0_v2.png'
+        new_url = self.state.serve_slice_image(0)
+        self.assertNotEqual(url, new_url)
+        self.assertIn('image_slice_0_v2_checkerboard.png', new_url)
+
+    def test_serve_slice_image_cache_bounded_by_slices(self):
+        self.state.image_slices = [np.zeros((10, 10, 4), dtype=np.uint8) for _ in range(3)]
+        self.state.image_slices_filenames = [
+            f'appstate-random/image_slice_{i}.png' for i in range(3)]
+        for _ in range(5):
+            for i in range(3):
+                self.state.image_slices[i] = self.state.image_slices[i].copy()
+                self.state.serve_slice_image(i)
+        self.assertEqual(len(self.state._slice_url_cache), 3)
+
+        # removing slices drops their urls
+        self.state.image_slices = [self.state.image_slices[0].copy()]
+        self.state.image_slices_filenames = self.state.image_slices_filenames[:1]
+        self.state.serve_slice_image(0)
+        self.assertEqual(list(self.state._slice_url_cache), [0])
+
+
+class TestServeSliceImageComposed(unittest.TestCase):
+    def setUp(self):
+        self.state = AppState()
+        self.state.filename = 'appstate-random'
+        self.state.imgData = Image.new('RGB', (10, 10))
+        self.state.image_slices = [np.zeros((10, 10, 4), dtype=np.uint8)]
+        self.state.image_slices_filenames = ['appstate-random/image_slice_0.png']
+
+    @patch('controller.AppState.serve_main_image')
+    def test_serve_slice_image_composed_reuses_composition(self, mock_serve_main_image):
+        with patch.object(AppState, 'slice_image_composed', wraps=self.state.slice_image_composed) as mock_compose:
+            self.state.serve_slice_image_composed(0, CompositeMode.CHECKERBOARD)
+            self.state.serve_slice_image_composed(0, CompositeMode.CHECKERBOARD)
+            self.assertEqual(mock_compose.call_count, 1)
+
+            self.state.image_slices_filenames[0] = 'appstate-random/image_slice_0_v2.png'
+            self.state.serve_slice_image_composed(0, CompositeMode.CHECKERBOARD)
+            self.assertEqual(mock_compose.call_count, 2)
+
+        self.assertEqual(mock_serve_main_image.call_count, 3)
+
+    @patch('controller.AppState.serve_main_image')
+    def test_serve_slice_image_composed_switching_slices(self, mock_serve_main_image):
+        self.state.image_slices.append(np.zeros((10, 10, 4), dtype=np.uint8))
+        self.state.image_slices_filenames.append('appstate-random/image_slice_1.png')
+        with patch.object(AppState, 'slice_image_composed', wraps=self.state.slice_image_composed) as mock_compose:
+            for index in [0, 1, 0, 1]:
+                self.state.serve_slice_image_composed(index, CompositeMode.GRAYSCALE)
+            self.assertEqual(mock_compose.call_count, 2)
+
+            # a replaced slice array is composed again
+            self.state.image_slices[0] = np.ones((10, 10, 4), dtype=np.uint8)
+            self.state.serve_slice_image_composed(0, CompositeMode.GRAYSCALE)
+            self.assertEqual(mock_compose.call_count, 3)
+
+
+class TestFromCache(unittest.TestCase):
+    def tearDown(self):
+        AppState.cache.pop('appstate-uncached', None)
+
+    @patch('controller.AppState.from_file')
+    def test_from_cache_loads_once(self, mock_from_file):
+        state = AppState.from_cache('appstate-uncached')
+        self.assertIs(state, mock_from_file.return_value)
+        self.assertIs(state, AppState.from_cache('appstate-uncached'))
+        mock_from_file.assert_called_once_with('appstate-uncached')
+
+
+class TestImgArray(unittest.TestCase):
+    def test_img_array_cached_until_image_changes(self):
+        state = AppState()
+        state.imgData = Image.new('RGBA', (4, 3), (1, 2, 3, 4))
+
+        array = state.img_array()
+        self.assertEqual(array.shape, (3, 4, 3))
+        self.assertFalse(array.flags.writeable)
+        self.assertIs(array, state.img_array())
+
+        state.imgData = Image.new('RGB', (4, 3), (5, 6, 7))
+        np.testing.assert_array_equal(state.img_array()[0, 0], [5, 6, 7])
+
+
+class TestThresholdSliderValues(unittest.TestCase):
+    def test_threshold_slider_values(self):
+        state = AppState()
+        self.assertEqual(state.threshold_slider_values(), [])
+
+        state.num_slices = 3
+        state.imgThresholds = [0, np.int64(50), 100, 255]
+        self.assertEqual(state.threshold_slider_values(), [50, 100])
+
+
+class TestDepthThresholds(unittest.TestCase):
+    @patch('controller.analyze_depth_histogram')
+    def test_depth_thresholds_cached_per_depth_map(self, mock_analyze):
+        mock_analyze.side_effect = lambda depth_map, num_slices: list(
+            range(num_slices + 1))
+        state = AppState()
+        state.depthMapData = np.zeros((4, 4), dtype=np.uint8)
+
+        thresholds = state.depth_thresholds(3)
+        self.assertEqual(thresholds, [0, 1, 2, 3])
+        thresholds[1] = 100  # callers modify the result in place
+        self.assertEqual(state.depth_thresholds(3), [0, 1, 2, 3])
+        self.assertEqual(state.depth_thresholds(4), [0, 1, 2, 3, 4])
+        self.assertEqual(mock_analyze.call_count, 2)
+
+        # a new depth map invalidates the cache
+        state.depthMapData = np.zeros((4, 4), dtype=np.uint8)
+        state.depth_thresholds(3)
+        self.assertEqual(mock_analyze.call_count, 3)
+
+
 class TestToFile(unittest.TestCase):
 
     def setUp(self):
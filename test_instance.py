@@ -92,6 +92,21 @@ class TestSegmentationModel(unittest.TestCase):
         blended_mask = self.model.mask_at_point_blended(self.mock_point)
         self.assertIsInstance(blended_mask, np.ndarray)
 
+    def test_sam_image_embeddings_cached(self):
+        self.model.model = MagicMock()
+        self.model.model.get_image_embeddings.side_effect = lambda pixels: object()
+
+        self.model.image = self.mock_image
+        first = self.model._sam_image_embeddings('pixels')
+        second = self.model._sam_image_embeddings('pixels')
+        self.assertIs(first, second)
+        self.model.model.get_image_embeddings.assert_called_once()
+
+        self.model.image = Image.new('RGB', (120, 90), color='black')
+        third = self.model._sam_image_embeddings('pixels')
+        self.assertIsNot(first, third)
+        self.assertEqual(self.model.model.get_image_embeddings.call_count, 2)
+
 
 if __name__ == '__main__':
     unittest.main()
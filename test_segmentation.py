@@ -1,5 +1,7 @@
 import unittest
-from segmentation import analyze_depth_histogram, blend_with_alpha, generate_simple_thresholds
+from unittest.mock import patch
+from segmentation import analyze_depth_histogram, blend_with_alpha, generate_simple_thresholds, \
+    remove_mask_from_alpha, generate_slice_depth_maps
 import numpy as np
 
 
@@ -100,6 +102,56 @@ class TestBlendWithAlpha(unittest.TestCase):
         # Assert that the result is as expected
         np.testing.assert_array_equal(target_image, expected_result)
 
+    def test_blend_with_alpha_uint8_matches_generic(self):
+        rng = np.random.default_rng(0)
+        target_image = rng.integers(0, 256, (20, 30, 4), dtype=np.uint8)
+        merge_image = rng.integers(0, 256, (20, 30, 4), dtype=np.uint8)
+
+        expected_result = target_image.astype(np.int64)
+        blend_with_alpha(expected_result, merge_image.astype(np.int64))
+
+        blend_with_alpha(target_image, merge_image)
+
+        np.testing.assert_array_equal(target_image, expected_result)
+
+
+class TestRemoveMaskFromAlpha(unittest.TestCase):
+    def test_remove_mask_from_alpha_uint8_matches_generic(self):
+        # every combination of mask and alpha value
+        image = np.zeros((256, 256, 4), dtype=np.uint8)
+        image[:, :, 3] = np.arange(256, dtype=np.uint8)
+        mask = np.repeat(np.arange(256, dtype=np.uint8)[:, None], 256, axis=1)
+
+        expected_result = remove_mask_from_alpha(image, mask.astype(np.int64))
+        result = remove_mask_from_alpha(image, mask)
+
+        self.assertEqual(result.dtype, np.uint8)
+        np.testing.assert_array_equal(result, expected_result)
+        self.assertEqual(result[0, 255], 255)
+        self.assertEqual(result[255, 255], 0)
+
+
+class TestGenerateSliceDepthMaps(unittest.TestCase):
+    @patch('segmentation.generate_depth_maps')
+    def test_generate_slice_depth_maps_batches(self, mock_generate_depth_maps):
+        mock_generate_depth_maps.side_effect = lambda images, model: [
+            np.full(image.shape[:2], image[0, 0, 0], dtype=np.uint8) for image in images]
+        image_slices = [np.full((4, 4, 4), i, dtype=np.uint8) for i in range(6)]
+        saved = []
+
+        def save_depth_map(i, depth_map):
+            saved.append(i)
+            return int(depth_map[0, 0])
+
+        result = generate_slice_depth_maps(
+            image_slices, [0, 2, 3, 5], 'model', save_depth_map, batch_size=3)
+
+        self.assertEqual(result, [0, 2, 3, 5])
+        self.assertEqual(sorted(saved), [0, 2, 3, 5])
+        self.assertEqual([len(call[0][0]) for call in mock_generate_depth_maps.call_args_list], [3, 1])
+        # only the rgb channels are passed to the model
+        self.assertEqual(mock_generate_depth_maps.call_args[0][0][0].shape, (4, 4, 3))
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
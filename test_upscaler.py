@@ -25,8 +25,8 @@ class TestUpscaler(unittest.TestCase):
     def test_upscale_image_tiled_overlap(self):
         # Mocking the creation of the model to skip loading model and processor
         with patch.object(self.upscaler, 'create_model'):
-            # Mock the upscale_tile function to return our dummy tile
-            with patch.object(self.upscaler, 'upscale_tile', return_value=self.upscaled_tile_dummy):
+            # Mock the upscale_tiles function to return our dummy tiles
+            with patch.object(self.upscaler, 'upscale_tiles', side_effect=lambda tiles, *args: [self.upscaled_tile_dummy] * len(tiles)):
                 # Mock the integrate_tile to ensure integral processing of tiles
                 with patch.object(self.upscaler, 'integrate_tile') as mock_integrate:
                     # Call the function to test
@@ -39,8 +39,8 @@ class TestUpscaler(unittest.TestCase):
     def test_upscale_image_tiled_no_overlap(self):
         # Mocking the creation of the model to skip loading model and processor
         with patch.object(self.upscaler, 'create_model'):
-            # Mock the upscale_tile function to return our dummy tile
-            with patch.object(self.upscaler, 'upscale_tile', return_value=self.upscaled_tile_dummy):
+            # Mock the upscale_tiles function to return our dummy tiles
+            with patch.object(self.upscaler, 'upscale_tiles', side_effect=lambda tiles, *args: [self.upscaled_tile_dummy] * len(tiles)):
                 # Mock the integrate_tile to ensure integral processing of tiles
                 with patch.object(self.upscaler, 'integrate_tile') as mock_integrate:
                     # Call the function to test
@@ -53,8 +53,8 @@ class TestUpscaler(unittest.TestCase):
     def test_upscale_image_tiled_no_mock(self):
         # Mocking the creation of the model to skip loading model and processor
         with patch.object(self.upscaler, 'create_model'):
-            # Mock the upscale_tile function to return our dummy tile
-            with patch.object(self.upscaler, 'upscale_tile', return_value=self.upscaled_tile_dummy_real):
+            # Mock the upscale_tiles function to return our dummy tiles
+            with patch.object(self.upscaler, 'upscale_tiles', side_effect=lambda tiles, *args: [self.upscaled_tile_dummy_real] * len(tiles)):
                 # Call the function to test
                 upscaled_image = self.upscaler.upscale_image_tiled(
                     self.input_image, overlap=64)
@@ -63,6 +63,41 @@ class TestUpscaler(unittest.TestCase):
                 self.assertEqual(upscaled_image.size, (2*800, 2*800))
 
 
+class TestUpscaleTiles(unittest.TestCase):
+    def test_upscale_tiles_simple(self):
+        upscaler = Upscaler(model_name="simple")
+        upscaler.create_model()
+
+        tiles = [np.zeros((64, 64, 3), dtype=np.uint8), np.zeros((64, 128, 3), dtype=np.uint8)]
+        upscaled_tiles = upscaler.upscale_tiles(tiles)
+
+        self.assertEqual([tile.size for tile in upscaled_tiles], [(128, 128), (256, 128)])
+
+    def test_upscale_tiles_batches_swin2sr(self):
+        upscaler = Upscaler()
+        tiles = [np.zeros((64, 64, 3), dtype=np.uint8)] * 3
+        with patch.object(upscaler, '_upscale_tiles_swin2sr', return_value=['a', 'b', 'c']) as mock_batch:
+            with patch.object(upscaler, 'upscale_tile') as mock_tile:
+                self.assertEqual(upscaler.upscale_tiles(tiles), ['a', 'b', 'c'])
+                mock_batch.assert_called_once_with(tiles)
+                mock_tile.assert_not_called()
+
+
+class TestTileCoordinates(unittest.TestCase):
+    def test_tile_coordinates_last_tile_is_full(self):
+        coordinates = Upscaler.tile_coordinates(800, 600, 512, 480)
+        self.assertEqual(coordinates, [
+            (0, 0, 0, 0, 512, 512),
+            (1, 0, 288, 0, 800, 512),
+            (0, 1, 0, 88, 512, 600),
+            (1, 1, 288, 88, 800, 600),
+        ])
+
+    def test_tile_coordinates_small_image(self):
+        coordinates = Upscaler.tile_coordinates(100, 50, 512, 480)
+        self.assertEqual(coordinates, [(0, 0, 0, 0, 100, 50)])
+
+
 class TestIntegrateTile(unittest.TestCase):
 
     def setUp(self):
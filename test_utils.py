@@ -1,8 +1,11 @@
 import unittest
+import cv2
+import numpy as np
 from PIL import Image
 from utils import (
     find_bounding_box, find_square_from_bounding_box, filename_add_version, filename_previous_version,
-    highlight_selected_element, encode_string_with_nonce, decode_string_with_nonce
+    highlight_selected_element, encode_string_with_nonce, decode_string_with_nonce,
+    postprocess_depth_map, feather_mask
 )
 
 
@@ -179,5 +182,110 @@ class TestEncodeStringWithNonce(unittest.TestCase):
         self.assertEqual(decoded, None)
 
 
+class TestFeatherMask(unittest.TestCase):
+    def feather_full_frame(self, mask, num_expand):
+        kernel = np.ones((num_expand, num_expand), np.uint8)
+        expanded_mask = cv2.dilate(mask, kernel, iterations=1)
+        return cv2.GaussianBlur(
+            expanded_mask, (num_expand * 2 + 1, num_expand * 2 + 1), 0)
+
+    def test_feather_mask_matches_full_frame_blur(self):
+        for y, x in [(40, 50), (0, 0), (90, 110)]:
+            mask = np.zeros((100, 120), dtype=np.uint8)
+            mask[y:y + 10, x:x + 10] = 255
+            np.testing.assert_array_equal(
+                feather_mask(mask, num_expand=8), self.feather_full_frame(mask, 8))
+
+    def test_feather_mask_empty(self):
+        mask = np.zeros((20, 20), dtype=np.uint8)
+        np.testing.assert_array_equal(feather_mask(mask, num_expand=5), mask)
+
+
+class TestPostprocessDepthMap(unittest.TestCase):
+    @staticmethod
+    def postprocess_depth_map_reference(depth_map, image_alpha, final_blur=5):
+        """The original implementation with masked 3x3 dilation passes."""
+        depth_map = depth_map.copy()
+        depth_map[image_alpha != 255] = 0
+        kernel = np.ones((3, 3), np.uint8)
+        image_alpha = cv2.erode(image_alpha, kernel, iterations=3)
+        depth_map_blur = cv2.blur(depth_map, (15, 15))
+        depth_map[image_alpha != 255] = depth_map_blur[image_alpha != 255]
+        for _ in range(20):
+            depth_map_dilated = cv2.dilate(depth_map, kernel, iterations=1)
+            depth_map[image_alpha != 255] = depth_map_dilated[image_alpha != 255]
+        if final_blur % 2 == 0:
+            final_blur += 1
+        depth_map = cv2.GaussianBlur(depth_map, (final_blur, final_blur), 0)
+        smallest_vale = int(np.quantile(depth_map[image_alpha == 255], 0.01))
+        depth_map = depth_map.astype(np.int16) - smallest_vale
+        return np.clip(depth_map, 0, 255).astype(np.uint8)
+
+    def test_postprocess_depth_map_normalizes_to_smallest_value(self):
+        depth_map = np.full((100, 100), 100, dtype=np.uint8)
+        depth_map[:, 50:] = 150
+        image_alpha = np.full((100, 100), 255, dtype=np.uint8)
+
+        result = postprocess_depth_map(depth_map, image_alpha, final_blur=1)
+
+        self.assertEqual(result.dtype, np.uint8)
+        self.assertEqual(result.min(), 0)
+        self.assertEqual(result[0, 0], 0)
+        self.assertEqual(result[0, 99], 50)
+
+    def test_postprocess_depth_map_extends_into_transparent_area(self):
+        depth_map = np.full((100, 100), 120, dtype=np.uint8)
+        image_alpha = np.zeros((100, 100), dtype=np.uint8)
+        image_alpha[20:80, 20:80] = 255
+
+        result = postprocess_depth_map(depth_map, image_alpha, final_blur=1)
+
+        # the opaque area is uniform, so everything normalizes to zero
+        # and the transparent border does not wrap around below zero
+        self.assertTrue(np.all(result == 0))
+
+    def test_postprocess_depth_map_matches_reference_with_alpha_holes(self):
+        rng = np.random.default_rng(0)
+        depth_map = cv2.GaussianBlur(
+            rng.integers(0, 256, (120, 160)).astype(np.uint8), (0, 0), 3)
+        depth_map = (depth_map.astype(np.int32) * 3 % 256).astype(np.uint8)
+        image_alpha = np.full(depth_map.shape, 255, dtype=np.uint8)
+        # transparent and feathered holes next to bright opaque pixels
+        image_alpha[20:50, 30:45] = 0
+        image_alpha[70:100, 90:140] = 128
+        image_alpha[:, :8] = 0
+        depth_map[15:55, 45:60] = 255
+
+        for final_blur in (1, 5):
+            result = postprocess_depth_map(
+                depth_map.copy(), image_alpha.copy(), final_blur=final_blur)
+            expected = self.postprocess_depth_map_reference(
+                depth_map, image_alpha, final_blur=final_blur)
+            np.testing.assert_array_equal(result, expected)
+
+    def test_postprocess_depth_map_large_blur_close_to_full_resolution(self):
+        depth_map = np.tile(np.arange(200, dtype=np.uint8), (120, 1))
+        depth_map[40:80, 60:120] = 250
+        image_alpha = np.full(depth_map.shape, 255, dtype=np.uint8)
+
+        result = postprocess_depth_map(depth_map.copy(), image_alpha, final_blur=51)
+
+        expected = cv2.GaussianBlur(depth_map, (51, 51), 0)
+        expected = cv2.subtract(expected, int(np.quantile(expected, 0.01)))
+        self.assertLessEqual(np.abs(result.astype(int) - expected).max(), 3)
+
+    def test_postprocess_depth_map_smallest_value_matches_quantile(self):
+        # the 1% quantile falls between the two lowest values and is interpolated
+        depth_map = np.full((10, 10), 50, dtype=np.uint8)
+        depth_map[0, 0] = 10
+        image_alpha = np.full(depth_map.shape, 255, dtype=np.uint8)
+
+        result = postprocess_depth_map(depth_map.copy(), image_alpha, final_blur=1)
+
+        smallest = int(np.quantile(depth_map, 0.01))
+        self.assertEqual(smallest, 49)
+        np.testing.assert_array_equal(result, cv2.subtract(depth_map, smallest))
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -1,12 +1,15 @@
 import unittest
 
 from unittest.mock import patch, MagicMock
+from dash import no_update
 from dash.exceptions import PreventUpdate
 from PIL import Image
 import numpy as np
 from pathlib import Path
 
 from webui import update_threshold_values, click_event, copy_to_clipboard, export_state_as_gltf, slice_upload
+from webui import save_state_json_deferred, serve_data, record_depth_input, download_data, download_url, app, undo_slice
+from webui import poll_depth_map_callback, depth_map_futures, dirty_states, flush_deferred_states
 from controller import AppState
 from segmentation import setup_camera_and_cards
 from utils import to_image_url
@@ -51,6 +54,24 @@ class TestUpdateThresholds(unittest.TestCase):
         self.assertEqual(state.imgThresholds, [
                          0, 255, 256, 257, 258, 254, 255])
 
+    @patch('webui.AppState.serve_main_image')
+    def test_update_threshold_values_clamped_to_current(self, mock_serve_main_image):
+        state = AppState()
+        state.imgThresholds = [0, 1, 2, 3, 4, 255]
+        state.slice_pixel = (1, 1)
+
+        filename = 'teststate'
+        state.cache[filename] = state
+
+        # moving the first slider to zero clamps it back to one
+        threshold_values, img_data = update_threshold_values(
+            [0, 2, 3, 4], 5, filename)
+
+        self.assertEqual(threshold_values, [1, 2, 3, 4])
+        self.assertEqual(state.imgThresholds, [0, 1, 2, 3, 4, 255])
+        self.assertIs(img_data, no_update)
+        mock_serve_main_image.assert_not_called()
+
 
 class TestClickEvent(unittest.TestCase):
 
@@ -223,6 +244,7 @@ class TestCopyToClipboard(unittest.TestCase):
         mock_state.slice_mask = np.zeros((100, 100))
         mock_state.selected_slice = None
         mock_state.imgData = mock_image
+        mock_state.img_array.return_value = np.zeros((100, 100, 3), dtype=np.uint8)
 
         mock_from_cache.return_value = mock_state
 
@@ -284,19 +306,19 @@ class TextExportGltf(unittest.TestCase):
         self.assertEqual(expected_kwargs["displacement_scale"], 0)
 
     @patch("PIL.Image.fromarray")
-    @patch("webui.generate_depth_map")
+    @patch("segmentation.generate_depth_maps")
     @patch("webui.postprocess_depth_map")
     @patch("webui.export_gltf")
     def test_export_state_as_gltf_with_displacement(
-            self, mock_export_gltf, mock_postprocess_depth_map, mock_generate_depth_map, mock_image_fromarray):
+            self, mock_export_gltf, mock_postprocess_depth_map, mock_generate_depth_maps, mock_image_fromarray):
         # Test case 2: Displacement scale is greater than 0
         camera_matrix, card_corners_3d_list = setup_camera_and_cards(
             self.state.image_slices, self.state.image_depths, 10, 100, 50)
 
         mock_export_gltf.return_value = Path("output.gltf")
 
-        mock_generate_depth_map.return_value = np.zeros(
-            (100, 100), dtype=np.float32)
+        mock_generate_depth_maps.side_effect = lambda images, model: [
+            np.zeros((100, 100), dtype=np.uint8) for _ in images]
         mock_postprocess_depth_map.return_value = np.zeros(
             (100, 100), dtype=np.uint8)
 
@@ -311,7 +333,9 @@ class TextExportGltf(unittest.TestCase):
             self.state, "output_dir", 10, 100, 50, 1, "midas")
 
         self.assertEqual(result, Path("output.gltf"))
-        self.assertEqual(mock_generate_depth_map.call_count, 3)
+        # all three slices are processed in a single batch
+        mock_generate_depth_maps.assert_called_once()
+        self.assertEqual(len(mock_generate_depth_maps.call_args[0][0]), 3)
         self.assertEqual(mock_postprocess_depth_map.call_count, 3)
         self.assertEqual(mock_image_fromarray.call_count, 3)
         mock_image.save.assert_called_with(
@@ -453,5 +477,167 @@ class TestSliceUpload(unittest.TestCase):
         self.assertIsInstance(mock_state.imgData, Image.Image)
 
 
+class TestRecordDepthInput(unittest.TestCase):
+    def setUp(self):
+        self.state = AppState()
+        self.state.filename = 'appstate-random'
+        self.state.image_depths = [10, 20]
+        self.state.image_slices = [np.zeros((2, 2, 4)), np.zeros((2, 2, 4))]
+        self.state.image_slices_filenames = ['slice0.png', 'slice1.png']
+        self.state.positive_prompts = ['', '']
+        self.state.negative_prompts = ['', '']
+        AppState.cache['appstate-random'] = self.state
+
+    def tearDown(self):
+        AppState.cache.pop('appstate-random', None)
+
+    @patch('webui.save_state_json_deferred')
+    @patch('webui.ctx')
+    def test_record_depth_input_unchanged(self, mock_ctx, mock_save):
+        mock_ctx.triggered_id = {'index': 1}
+        with self.assertRaises(PreventUpdate):
+            record_depth_input([10, 20], [None, 1], 'appstate-random')
+        mock_save.assert_not_called()
+
+    @patch('webui.save_state_json_deferred')
+    @patch('webui.ctx')
+    def test_record_depth_input_changed(self, mock_ctx, mock_save):
+        mock_ctx.triggered_id = {'index': 1}
+        result = record_depth_input([10, 5], [None, 1], 'appstate-random')
+        self.assertEqual(result, (True, True))
+        self.assertEqual(self.state.image_depths, [5, 10])
+        mock_save.assert_called_once_with('appstate-random', self.state)
+
+
+class TestUndoSlice(unittest.TestCase):
+    def setUp(self):
+        self.state = MagicMock(spec=AppState)
+        AppState.cache['appstate-random'] = self.state
+
+    def tearDown(self):
+        AppState.cache.pop('appstate-random', None)
+
+    @patch('webui.save_state_json_deferred')
+    @patch('webui.ctx')
+    def test_undo_slice_uses_triggered_button(self, mock_ctx, mock_save):
+        mock_ctx.triggered_id = {'type': 'slice-undo-forwards', 'index': 1}
+        mock_ctx.triggered = [{'value': 2}]
+        self.state.undo.return_value = True
+
+        self.assertTrue(undo_slice([1, None], [None, 2], 'appstate-random'))
+        self.state.undo.assert_called_once_with(1, forward=True)
+        mock_save.assert_called_once_with('appstate-random', self.state)
+
+    @patch('webui.ctx')
+    def test_undo_slice_without_click(self, mock_ctx):
+        mock_ctx.triggered_id = {'type': 'slice-undo-backwards', 'index': 0}
+        mock_ctx.triggered = [{'value': None}]
+
+        with self.assertRaises(PreventUpdate):
+            undo_slice([None], [None], 'appstate-random')
+        self.state.undo.assert_not_called()
+
+
+class TestPollDepthMap(unittest.TestCase):
+    def tearDown(self):
+        depth_map_futures.clear()
+
+    def test_poll_depth_map_pending(self):
+        with self.assertRaises(PreventUpdate):
+            poll_depth_map_callback(1, 'appstate-random')
+
+        future = MagicMock()
+        future.done.return_value = False
+        depth_map_futures['appstate-random'] = future
+        with self.assertRaises(PreventUpdate):
+            poll_depth_map_callback(1, 'appstate-random')
+        self.assertIn('appstate-random', depth_map_futures)
+
+    def test_poll_depth_map_done_clears_loading(self):
+        future = MagicMock()
+        future.done.return_value = True
+        depth_map_futures['appstate-random'] = future
+
+        result = poll_depth_map_callback(1, 'appstate-random')
+
+        self.assertEqual(result, (True, 'auto', False))
+        self.assertNotIn('appstate-random', depth_map_futures)
+
+    def test_poll_depth_map_error_clears_loading(self):
+        future = MagicMock()
+        future.done.return_value = True
+        future.result.side_effect = RuntimeError('model failed')
+        depth_map_futures['appstate-random'] = future
+
+        result = poll_depth_map_callback(1, 'appstate-random')
+
+        self.assertEqual(result, (no_update, 'auto', False))
+
+
+@patch('webui.state_writer', MagicMock())  # keep the background writer out of the tests
+class TestSaveStateJsonDeferred(unittest.TestCase):
+    def tearDown(self):
+        dirty_states.clear()
+
+    def test_saves_are_coalesced(self):
+        mock_state = MagicMock(spec=AppState)
+
+        for _ in range(5):
+            save_state_json_deferred('appstate-random', mock_state)
+        self.assertTrue(flush_deferred_states())
+
+        mock_state.to_file.assert_called_once_with(
+            'appstate-random', save_image_slices=False, save_depth_map=False, save_input_image=False)
+        self.assertEqual(dirty_states, {})
+
+    def test_failed_save_is_retried(self):
+        mock_state = MagicMock(spec=AppState)
+        mock_state.to_file.side_effect = [OSError('disk full'), None]
+
+        save_state_json_deferred('appstate-random', mock_state)
+        with patch('builtins.print'):
+            self.assertFalse(flush_deferred_states())
+        self.assertIs(dirty_states['appstate-random'], mock_state)
+
+        self.assertTrue(flush_deferred_states())
+        self.assertEqual(mock_state.to_file.call_count, 2)
+        self.assertEqual(dirty_states, {})
+
+
+class TestServeData(unittest.TestCase):
+    @patch('webui.send_file')
+    def test_serve_data_mimetypes(self, mock_send_file):
+        for filename, mimetype in [
+                ('state/model.gltf', 'model/gltf+json'),
+                ('state/depth_map_preview.webp', 'image/webp'),
+                ('state/input_image.jpg', 'image/jpeg'),
+                ('state/image_slice_0.png', 'image/png')]:
+            serve_data(filename)
+            args, kwargs = mock_send_file.call_args
+            self.assertTrue(args[0].endswith(filename))
+            self.assertEqual(kwargs['mimetype'], mimetype)
+
+    @patch('webui.send_from_directory')
+    def test_download_data_streams_attachment(self, mock_send_from_directory):
+        with app.server.test_request_context('/download/state/model.gltf?name=scene.gltf'):
+            download_data('state/model.gltf')
+
+        args, kwargs = mock_send_from_directory.call_args
+        self.assertEqual(args[1], 'state/model.gltf')
+        self.assertTrue(kwargs['as_attachment'])
+        self.assertTrue(kwargs['conditional'])
+        self.assertEqual(kwargs['download_name'], 'scene.gltf')
+
+    def test_download_data_rejects_path_traversal(self):
+        client = app.server.test_client()
+        for path in ['/download/..%2fsecret.txt', '/download/state/..%2f..%2fsecret.txt']:
+            response = client.get(path)
+            self.assertEqual(response.status_code, 404)
+
+    def test_download_url(self):
+        url = download_url(Path('appstate-random') / 'model.gltf', 'scene.gltf')
+        self.assertTrue(url.startswith('/download/appstate-random/model.gltf?name=scene.gltf&v='))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -21,7 +21,7 @@ from transformers import AutoImageProcessor, Swin2SRForImageSuperResolution
 import numpy as np
 from scipy.ndimage import zoom
 
-from utils import torch_get_device, premultiply_alpha_numpy, find_bounding_box
+from utils import torch_get_device, torch_autocast, premultiply_alpha_numpy, find_bounding_box
 import argparse
 
 
@@ -34,6 +34,7 @@ class Upscaler:
         self.external_model = external_model
         self.tile_size = 512
         self.scale_factor = 2
+        self.batch_size = 4
 
     def create_model(self):
         if self.model_name == "swin2sr":
@@ -104,11 +105,10 @@ class Upscaler:
         if overlap % self.scale_factor != 0:
             overlap = (overlap // self.scale_factor + 1) * self.scale_factor
 
-        # Calculate the number of tiles
+        # Calculate the tile coordinates
         height, width, _ = image.shape
         step_size = self.tile_size - overlap // self.scale_factor
-        num_tiles_x = (width + step_size - 1) // step_size
-        num_tiles_y = (height + step_size - 1) // step_size
+        coordinates = self.tile_coordinates(width, height, self.tile_size, step_size)
 
         # Create a new array to store the upscaled result
         upscaled_height = height * self.scale_factor
@@ -116,42 +116,32 @@ class Upscaler:
         upscaled_image = np.zeros(
             (upscaled_height, upscaled_width, 3), dtype=np.uint8)
 
-        # Iterate over the tiles
-        for y in range(num_tiles_y):
-            for x in range(num_tiles_x):
-                # Calculate the coordinates of the current tile
-                left = x * step_size
-                top = y * step_size
-                right = min(left + self.tile_size, width)
-                bottom = min(top + self.tile_size, height)
-                
-                # make sure we process a full tile
-                if x > 0 and right - left < self.tile_size:
-                    left = right - self.tile_size
-                    assert left >= 0
-                if y > 0 and bottom - top < self.tile_size:
-                    top = bottom - self.tile_size
-                    assert top >= 0
+        for start in range(0, len(coordinates), self.batch_size):
+            batch = coordinates[start:start + self.batch_size]
 
+            tiles = []
+            for x, y, left, top, right, bottom in batch:
                 print(
                     f"Processing tile ({y}, {x}) with coordinates ({left}, {top}, {right}, {bottom})")
 
-                # Extract the current tile from the image
+                # Extract the current tile from the image - it stays a numpy view unless it needs resizing
                 tile = image[top:bottom, left:right]
-                # XXX - revisit whether we can keep this as a numpy array
-                tile = Image.fromarray(tile)
 
-                cur_width, cur_height = tile.size
+                cur_height, cur_width = tile.shape[:2]
                 if cur_width % 64 != 0 or cur_height % 64 != 0:
                     new_width = cur_width + (64 - cur_width % 64) if cur_width % 64 != 0 else cur_width
                     new_height = cur_height + (64 - cur_height % 64) if cur_height % 64 != 0 else cur_height
-                    tile = tile.resize((new_width, new_height))
-                upscaled_tile = self.upscale_tile(
-                    tile, prompt, negative_prompt)
-                if tile.size != (cur_width, cur_height):
-                    upscaled_tile = upscaled_tile.resize(
-                        (cur_width * self.scale_factor, cur_height * self.scale_factor))
-                upscaled_tile = np.array(upscaled_tile)
+                    tile = np.array(Image.fromarray(tile).resize((new_width, new_height)))
+                tiles.append(tile)
+
+            upscaled_tiles = self.upscale_tiles(tiles, prompt, negative_prompt)
+
+            for (x, y, left, top, right, bottom), tile, upscaled_tile in zip(batch, tiles, upscaled_tiles):
+                cur_width, cur_height = right - left, bottom - top
+                upscaled_tile = np.asarray(upscaled_tile)
+                if tile.shape[:2] != (cur_height, cur_width):
+                    upscaled_tile = np.array(Image.fromarray(upscaled_tile).resize(
+                        (cur_width * self.scale_factor, cur_height * self.scale_factor)))
 
                 # Calculate the coordinates to paste the upscaled tile
                 place_left = left * self.scale_factor
@@ -177,6 +167,42 @@ class Upscaler:
 
         return upscaled_image
 
+    @staticmethod
+    def tile_coordinates(width, height, tile_size, step_size):
+        """
+        Computes the coordinates of all tiles covering an image in the order they are integrated.
+
+        Args:
+            width (int): The width of the image.
+            height (int): The height of the image.
+            tile_size (int): The size of a tile.
+            step_size (int): The distance between the top-left corners of neighboring tiles.
+
+        Returns:
+            list: Tuples of (x, y, left, top, right, bottom) with the tile indices and pixel coordinates.
+        """
+        num_tiles_x = (width + step_size - 1) // step_size
+        num_tiles_y = (height + step_size - 1) // step_size
+
+        coordinates = []
+        for y in range(num_tiles_y):
+            for x in range(num_tiles_x):
+                left = x * step_size
+                top = y * step_size
+                right = min(left + tile_size, width)
+                bottom = min(top + tile_size, height)
+
+                # make sure we process a full tile
+                if x > 0 and right - left < tile_size:
+                    left = right - tile_size
+                    assert left >= 0
+                if y > 0 and bottom - top < tile_size:
+                    top = bottom - tile_size
+                    assert top >= 0
+
+                coordinates.append((x, y, left, top, right, bottom))
+        return coordinates
+
     @staticmethod
     def integrate_tile(tile, image, left, top, right, bottom, tile_x, tile_y, overlap):
         height, width, _ = tile.shape
@@ -185,26 +211,45 @@ class Upscaler:
         if overlap >= height or overlap >= width:
             return
 
-        # Create an alpha channel for the tile
-        alpha = np.ones((height, width), dtype=np.float32)
-        if tile_x > 0 and tile_y > 0:
-            alpha[:overlap, :overlap] = np.outer(
-                np.linspace(0, 1, overlap), np.linspace(0, 1, overlap))
-        if tile_x > 0:
-            new_alpha = np.tile(np.linspace(0, 1, overlap), (height, 1))
-            alpha[:, :overlap] = np.minimum(alpha[:, :overlap], new_alpha)
+        target = image[top:bottom, left:right]
+
+        # only the overlapping strips need blending - the rest of the tile is copied as is
+        start_y = overlap if tile_y > 0 else 0
+        start_x = overlap if tile_x > 0 else 0
+        target[start_y:, start_x:] = tile[start_y:, start_x:]
 
+        ramp = np.linspace(0, 1, overlap)
         if tile_y > 0:
-            new_alpha = np.tile(np.linspace(
-                0, 1, overlap).reshape(-1, 1), (1, width))
-            alpha[:overlap, :] = np.minimum(alpha[:overlap, :], new_alpha)
+            alpha = np.tile(ramp.reshape(-1, 1), (1, width)).astype(np.float32)
+            if tile_x > 0:
+                alpha[:, :overlap] = np.outer(ramp, ramp)
+            Upscaler._blend_strip(tile[:overlap], target[:overlap], alpha)
+        if tile_x > 0:
+            alpha = np.tile(ramp, (height - start_y, 1)).astype(np.float32)
+            Upscaler._blend_strip(
+                tile[start_y:, :overlap], target[start_y:, :overlap], alpha)
+
+    @staticmethod
+    def _blend_strip(tile, target, alpha):
+        """Alpha blends a strip of a tile into the target view in place."""
+        alpha = alpha[:, :, np.newaxis]
+        target[:] = (alpha * tile + (1 - alpha) * target).astype(np.uint8)
+
+    def upscale_tiles(self, tiles, prompt=None, negative_prompt=None):
+        """
+        Upscales a list of tiles. Swin2SR processes tiles of the same size in a single forward pass.
 
-        # Reshape the alpha channel to match the tile shape
-        alpha = alpha.reshape(height, width, 1)
+        Args:
+            tiles (list): The input tiles as numpy arrays.
+            prompt (str, optional): The prompt for models that support it.
+            negative_prompt (str, optional): The negative prompt for models that support it.
 
-        # Apply the tile with alpha blending to the image
-        image[top:bottom, left:right] = (
-            alpha * tile + (1 - alpha) * image[top:bottom, left:right]).astype(np.uint8)
+        Returns:
+            list: The upscaled tiles as numpy arrays or PIL images in the same order as the input tiles.
+        """
+        if self.model_name == "swin2sr" and len({tile.shape for tile in tiles}) == 1:
+            return self._upscale_tiles_swin2sr(tiles)
+        return [self.upscale_tile(Image.fromarray(tile), prompt, negative_prompt) for tile in tiles]
 
     def upscale_tile(self, tile, prompt=None, negative_prompt=None):
         if self.model_name == "swin2sr":
@@ -258,20 +303,32 @@ class Upscaler:
             tile: The input tile to be upscaled.
 
         Returns:
-            An Image object representing the upscaled tile.
+            A numpy array representing the upscaled tile.
+        """
+        return self._upscale_tiles_swin2sr([tile])[0]
+
+    def _upscale_tiles_swin2sr(self, tiles):
+        """
+        Upscales a batch of tiles of the same size with a single forward pass of the Swin2SR model.
+
+        Args:
+            tiles: The input tiles to be upscaled.
+
+        Returns:
+            A list of numpy arrays representing the upscaled tiles.
         """
-        inputs = self.image_processor(tile, return_tensors="pt")
+        inputs = self.image_processor(tiles, return_tensors="pt")
         inputs = {name: tensor.to(self.model.device)
                   for name, tensor in inputs.items()}
 
-        with torch.no_grad():
+        with torch.no_grad(), torch_autocast(self.model.device):
             outputs = self.model(**inputs)
 
-        output = outputs.reconstruction.squeeze().float().cpu().clamp_(0, 1).numpy()
-        output = np.moveaxis(output, source=0, destination=-1)
-        output = (output * 255.0).round().astype(np.uint8)
+        # convert to uint8 on the device, so that only a quarter of the bytes are copied back
+        output = outputs.reconstruction.float().clamp_(0, 1).mul_(255.0).round_().to(torch.uint8)
+        output = output.permute(0, 2, 3, 1).cpu().numpy()
 
-        return Image.fromarray(output)
+        return list(output)
 
 
 if __name__ == "__main__":
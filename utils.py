@@ -2,6 +2,7 @@
 #
 
 import io
+import contextlib
 from functools import wraps
 import cv2
 import time
@@ -89,6 +90,44 @@ def torch_get_device():
     return torch.device("cpu")
 
 
+def torch_autocast(device=None):
+    """
+    Returns an autocast context that runs inference in float16 on CUDA devices.
+
+    Args:
+        device (torch.device, optional): The device the model runs on. Defaults to torch_get_device().
+
+    Returns:
+        A context manager - a no-op on devices other than CUDA.
+    """
+    if device is None:
+        device = torch_get_device()
+    if device.type == "cuda":
+        return torch.autocast(device_type="cuda", dtype=torch.float16)
+    return contextlib.nullcontext()
+
+
+def torch_to_device(tensor, device=None):
+    """
+    Moves a tensor to the device, copying through pinned memory on CUDA devices.
+
+    Pinned host memory lets the host to device copy run asynchronously instead of
+    going through an extra staging buffer.
+
+    Args:
+        tensor (torch.Tensor): The tensor on the host.
+        device (torch.device, optional): The target device. Defaults to torch_get_device().
+
+    Returns:
+        torch.Tensor: The tensor on the device.
+    """
+    if device is None:
+        device = torch_get_device()
+    if device.type == "cuda":
+        return tensor.pin_memory().to(device, non_blocking=True)
+    return tensor.to(device)
+
+
 def find_bounding_box(mask_image, padding=50):
     """
     Finds the bounding box of a given mask image.
@@ -235,6 +274,40 @@ def find_pixel_from_event(state, e, rect_data):
     return find_pixel_from_click(state.imgData, x, y, rectWidth, rectHeight)
 
 
+def _blur_mask_region(mask, ksize):
+    """
+    Gaussian blurs a mask, restricting the work to the area around its non-zero pixels.
+
+    The blur is computed on the bounding box of the mask padded by twice the kernel
+    radius. Within that padding the mask is zero, so the reflected border of the crop
+    matches the pixels outside of it and the result is identical to blurring the
+    whole mask.
+
+    Args:
+        mask (numpy.ndarray): The input mask.
+        ksize (tuple): The Gaussian kernel size.
+
+    Returns:
+        numpy.ndarray: The blurred mask.
+    """
+    if mask.ndim != 2 or mask.dtype != np.uint8:
+        return cv2.GaussianBlur(mask, ksize, 0)
+
+    x, y, width, height = cv2.boundingRect(mask)
+    if width == 0 or height == 0:
+        return mask.copy()
+
+    pad = max(ksize) - 1  # twice the kernel radius
+    top, left = max(y - pad, 0), max(x - pad, 0)
+    bottom = min(y + height + pad, mask.shape[0])
+    right = min(x + width + pad, mask.shape[1])
+
+    blurred_mask = np.zeros_like(mask)
+    blurred_mask[top:bottom, left:right] = cv2.GaussianBlur(
+        mask[top:bottom, left:right], ksize, 0)
+    return blurred_mask
+
+
 def feather_mask(mask, num_expand=50):
     """
     Expand and feather a mask.
@@ -256,8 +329,8 @@ def feather_mask(mask, num_expand=50):
     expanded_mask = cv2.dilate(mask, kernel, iterations=1)
 
     # Feather the expanded mask
-    feathered_mask = cv2.GaussianBlur(
-        expanded_mask, (num_expand * 2 + 1, num_expand * 2 + 1), 0)
+    feathered_mask = _blur_mask_region(
+        expanded_mask, (num_expand * 2 + 1, num_expand * 2 + 1))
 
     if was_pil_image:
         feathered_mask = Image.fromarray(feathered_mask)
@@ -280,32 +353,60 @@ def postprocess_depth_map(depth_map, image_alpha, final_blur=5):
     """
     depth_map[image_alpha != 255] = 0
 
-    kernel = np.ones((3, 3), np.uint8)
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
 
     # erode the alpha channel to remove the feathering
     image_alpha = cv2.erode(image_alpha, kernel, iterations=3)
 
+    # compute the mask of the region to extend into only once
+    alpha_mask = cv2.compare(image_alpha, 255, cv2.CMP_NE)
+
     depth_map_blur = cv2.blur(depth_map, (15, 15))
-    depth_map[image_alpha != 255] = depth_map_blur[image_alpha != 255]
+    cv2.copyTo(depth_map_blur, alpha_mask, depth_map)
 
-    for i in range(20):
-        depth_map_dilated = cv2.dilate(depth_map, kernel, iterations=1)
-        depth_map[image_alpha != 255] = depth_map_dilated[image_alpha != 255]
+    # grow the depth into the masked region one pixel per pass; values must only
+    # propagate through the masked region, so this cannot be a single larger dilation
+    for _ in range(20):
+        depth_map_dilated = cv2.dilate(depth_map, kernel)
+        cv2.copyTo(depth_map_dilated, alpha_mask, depth_map)
 
     # make final blur an odd number - required by GaussianBlur
     if final_blur % 2 == 0:
         final_blur += 1
-    depth_map = cv2.GaussianBlur(depth_map, (final_blur, final_blur), 0)
-
-    # normalize to the smallest value
-    smallest_vale = int(np.quantile(depth_map[image_alpha == 255], 0.01))
-    smallest_vale = int(smallest_vale)
-
-    # change dtype of depth map to int
-    depth_map = depth_map.astype(np.int16)
-    depth_map[:, :] -= smallest_vale
-    depth_map = np.clip(depth_map, 0, 255)
-    depth_map = depth_map.astype(np.uint8)
+    # sigma that OpenCV derives from the kernel size
+    sigma = 0.3 * ((final_blur - 1) * 0.5 - 1) + 0.8
+    scale = int(sigma // 3)
+    if scale >= 2:
+        # large blurs are computed at a lower resolution, keeping a sigma of at least
+        # 3 pixels there; the result differs from the full blur by a few levels at most
+        height, width = depth_map.shape[:2]
+        small = cv2.resize(depth_map, (max(width // scale, 1), max(height // scale, 1)),
+                           interpolation=cv2.INTER_AREA)
+        small = cv2.GaussianBlur(small, (0, 0), sigmaX=sigma / scale)
+        depth_map = cv2.resize(small, (width, height), interpolation=cv2.INTER_LINEAR)
+    else:
+        depth_map = cv2.GaussianBlur(depth_map, (final_blur, final_blur), 0)
+
+    # normalize to the smallest value - the 1% quantile of the opaque
+    # pixels is read from a histogram instead of sorting a gathered copy
+    hist = cv2.calcHist([depth_map], [0], cv2.bitwise_not(alpha_mask),
+                        [256], [0, 256]).ravel()
+    cdf = np.cumsum(hist)
+    smallest_vale = 0
+    if cdf[-1] > 0:
+        # interpolate between the two nearest ranks like np.quantile does
+        position = 0.01 * (cdf[-1] - 1)
+        rank = int(position)
+        fraction = position - rank
+        lower = int(np.searchsorted(cdf, rank + 1))
+        upper = int(np.searchsorted(cdf, min(rank + 2, cdf[-1])))
+        if fraction >= 0.5:
+            smallest_vale = int(upper - (upper - lower) * (1 - fraction))
+        else:
+            smallest_vale = int(lower + (upper - lower) * fraction)
+
+    # uint8 subtraction in OpenCV saturates at 0
+    depth_map = cv2.subtract(depth_map, smallest_vale)
 
     return depth_map
 
@@ -2,17 +2,23 @@
 # (c) 2024 Niels Provos
 
 import argparse
-import base64
+import atexit
+import binascii
 import io
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from urllib.parse import quote
 from PIL import Image
 import numpy as np
+import cv2
 
 import constants as C
 from segmentation import (
     generate_depth_map,
-    analyze_depth_histogram,
+    generate_slice_depth_maps,
     generate_image_slices,
     create_slice_from_mask,
     setup_camera_and_cards,
@@ -36,10 +42,10 @@ from clientside import make_clientside_callbacks
 import dash
 from dash import dcc, html, ctx, no_update
 from dash.dependencies import Input, Output, State
-from dash.dependencies import ALL, MATCH
+from dash.dependencies import ALL
 from dash_extensions import EventListener
 from dash.exceptions import PreventUpdate
-from flask import send_file
+from flask import request, send_file, send_from_directory
 from werkzeug import serving
 
 from controller import AppState, CompositeMode
@@ -47,11 +53,80 @@ from controller import AppState, CompositeMode
 # Globals
 EXPAND_MASK = 5
 HIGHLIGHT_COLOR = 'color-is-selected-light'
+DEPTH_BATCH_SIZE = 4  # slices per depth model forward pass during export
 
 # Progress tracking variables
 current_progress = -1
 total_progress = 100
 
+# Depth maps are generated on a background thread so that inference does not
+# block a callback worker; pending results are keyed by the state filename
+DEPTH_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+depth_map_futures = {}
+depth_map_futures_lock = threading.Lock()
+
+# Saves that only update the state JSON are coalesced on a background thread
+STATE_SAVE_DELAY = 0.2
+STATE_SAVE_RETRY_DELAY = 5.0
+dirty_states = {}
+dirty_states_lock = threading.Lock()
+dirty_states_event = threading.Event()
+state_flush_lock = threading.Lock()  # lets a flush wait for a write in progress
+state_writer = None
+
+
+def flush_deferred_states():
+    """Writes the state JSON of all pending deferred saves.
+
+    Saves that fail stay queued for the next flush.
+
+    Returns:
+        bool: True if all pending states were written.
+    """
+    with state_flush_lock:
+        with dirty_states_lock:
+            states = list(dirty_states.items())
+            dirty_states.clear()
+            dirty_states_event.clear()
+        failed = []
+        for filename, state in states:
+            try:
+                state.to_file(filename, save_image_slices=False,
+                              save_depth_map=False, save_input_image=False)
+            except Exception as e:
+                print(f"Failed to save state {filename}: {e}")
+                failed.append((filename, state))
+        if failed:
+            with dirty_states_lock:
+                for filename, state in failed:
+                    dirty_states.setdefault(filename, state)
+                dirty_states_event.set()
+        return not failed
+
+
+def state_writer_loop():
+    while True:
+        dirty_states_event.wait()
+        # give quick successive edits a chance to coalesce into one write
+        time.sleep(STATE_SAVE_DELAY)
+        if not flush_deferred_states():
+            time.sleep(STATE_SAVE_RETRY_DELAY)
+
+
+def save_state_json_deferred(filename, state):
+    """Schedules a save of the state JSON; multiple calls within STATE_SAVE_DELAY result in one write."""
+    global state_writer
+    with dirty_states_lock:
+        if state_writer is None:
+            state_writer = threading.Thread(target=state_writer_loop, daemon=True)
+            state_writer.start()
+        dirty_states[filename] = state
+        dirty_states_event.set()
+
+
+# the writer is a daemon thread, so write the edits it has not saved yet on exit
+atexit.register(flush_deferred_states)
+
 
 def progress_callback(current, total):
     global current_progress, total_progress
@@ -69,16 +144,36 @@ app = dash.Dash(__name__,
                 external_scripts=external_scripts)
 
 # Create a Flask route for serving images
+SERVE_ROOT = Path(os.getcwd())
+SERVE_MIMETYPES = {
+    '.gltf': 'model/gltf+json',
+    '.png': 'image/png',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.webp': 'image/webp',
+    '.bmp': 'image/bmp',
+}
 
 
 @app.server.route(f'/{AppState.SRV_DIR}/<path:filename>')
 def serve_data(filename):
-    filename = Path(os.getcwd()) / filename
-    if filename.suffix == '.gltf':
-        mimetype = 'model/gltf+json'
-    else:
-        mimetype = f'image/{filename.suffix[1:]}'
-    return send_file(str(filename), mimetype=mimetype)
+    suffix = os.path.splitext(filename)[1]
+    mimetype = SERVE_MIMETYPES.get(suffix, f'image/{suffix[1:]}')
+    return send_file(str(SERVE_ROOT / filename), mimetype=mimetype)
+
+
+@app.server.route('/download/<path:filename>')
+def download_data(filename):
+    """Streams a file from the state directory as an attachment."""
+    download_name = request.args.get('name', Path(filename).name)
+    # send_from_directory rejects paths that escape the served root
+    return send_from_directory(SERVE_ROOT, filename, as_attachment=True,
+                               download_name=download_name, conditional=True)
+
+
+def download_url(path, name):
+    """Returns the url that downloads the file at path; the timestamp makes repeated downloads fire."""
+    return f'/download/{quote(str(path))}?name={quote(name)}&v={time.time_ns()}'
 
 
 # JavaScript event(s) that we want to listen to and what properties to collect.
@@ -201,24 +296,13 @@ def toggle_dark_mode(n_clicks, filename):
         state = AppState.from_cache(filename)
         if state.dark_mode != dark_mode:
             state.dark_mode = dark_mode
-            state.to_file(filename, save_image_slices=False,
-                          save_depth_map=False, save_input_image=False)
+            save_state_json_deferred(filename, state)
 
     if dark_mode:
         return 'dark min-h-screen', 'fas fa-sun'
     else:
         return 'min-h-screen', 'fas fa-moon'
 
-# Callback for the logs
-
-
-@app.callback(Output('log', 'children'),
-              Input(C.LOGS_DATA, 'data'),
-              prevent_initial_call=True)
-def update_logs(data):
-    structured_logs = [html.Div(log) for log in data[-3:]]
-    return structured_logs
-
 # Callback to update progress bar
 
 
@@ -231,7 +315,10 @@ def update_logs(data):
 def update_progress(n):
     progress_bar = html.Div(className='progress-bar-fill',
                             style={'width': f'{max(0, current_progress)}%'})
-    interval_disabled = current_progress >= total_progress or current_progress == -1
+    with depth_map_futures_lock:
+        depth_maps_pending = bool(depth_map_futures)
+    interval_disabled = (current_progress >= total_progress or current_progress == -1) \
+        and not depth_maps_pending
     return progress_bar, interval_disabled
 
 
@@ -249,28 +336,29 @@ def update_threshold_values(threshold_values, num_slices, filename):
 
     state = AppState.from_cache(filename)
 
-    if state.imgThresholds[1:-1] == threshold_values:
+    values = np.array(threshold_values, dtype=np.int64)
+    if np.array_equal(values, state.imgThresholds[1:-1]):
         print("Threshold values are the same; not erasing data.")
         raise PreventUpdate()
 
-    # make sure that threshold values are monotonically increasing
-    if threshold_values[0] <= 0:
-        threshold_values[0] = 1
+    # num slices is the number of thresholds + 1, so only the first num_slices - 1 values are ordered
+    count = num_slices - 1
+    steps = np.arange(count)
 
-    for i in range(1, num_slices-1):
-        if threshold_values[i] <= threshold_values[i-1]:
-            threshold_values[i] = threshold_values[i-1] + 1
+    # make sure that threshold values are monotonically increasing:
+    # v[i] > v[i-1] is the same as v[i] - i >= v[i-1] - (i-1), i.e. a running maximum
+    values[0] = max(values[0], 1)
+    values[:count] = np.maximum.accumulate(values[:count] - steps) + steps
 
     # go through the list in reverse order to make sure that the thresholds are monotonically decreasing
-    if threshold_values[-1] >= 255:
-        threshold_values[-1] = 254
-
-    # num slices is the number of thresholds + 1, so the largest index is num_slices - 2
-    # and the second largest index is num_slices - 3
-    for i in range(num_slices-3, -1, -1):
-        if threshold_values[i] >= threshold_values[i+1]:
-            threshold_values[i] = threshold_values[i+1] - 1
-
+    values[-1] = min(values[-1], 254)
+    values[:count] = np.minimum.accumulate(
+        (values[:count] - steps)[::-1])[::-1] + steps
+
+    threshold_values = values.tolist()
+    if threshold_values == state.imgThresholds[1:-1]:
+        # a slider was clamped back to its old position; only reset the sliders
+        return threshold_values, no_update
     state.imgThresholds[1:-1] = threshold_values
 
     img_data = no_update
@@ -286,35 +374,6 @@ def update_threshold_values(threshold_values, num_slices, filename):
     return threshold_values, img_data
 
 
-@app.callback(
-    Output(C.CTR_THRESHOLDS, 'children'),
-    Input(C.STORE_UPDATE_THRESHOLD_CONTAINER, 'data'),
-    State(C.STORE_APPSTATE_FILENAME, 'data'),
-    prevent_initial_call=True
-)
-def update_thresholds_html(value, filename):
-    if filename is None:
-        raise PreventUpdate()
-
-    state = AppState.from_cache(filename)
-    thresholds = []
-    for i in range(1, state.num_slices):
-        threshold = html.Div([
-            dcc.Slider(
-                id={'type': 'threshold-slider', 'index': i},
-                min=0,
-                max=255,
-                step=1,
-                value=state.imgThresholds[i],
-                marks=None,
-                tooltip={'always_visible': True, 'placement': 'right'},
-            )
-        ], className='m-1 pl-1')
-        thresholds.append(threshold)
-
-    return thresholds
-
-
 @app.callback(
     Output(C.STORE_UPDATE_THRESHOLD_CONTAINER, 'data', allow_duplicate=True),
     Output(C.LOGS_DATA, 'data', allow_duplicate=True),
@@ -345,12 +404,12 @@ def update_thresholds(contents, num_slices, filename, logs_data):
         state.imgThresholds.extend([i * (255 // (num_slices - 1))
                                     for i in range(1, num_slices)])
     elif state.imgThresholds is None or len(state.imgThresholds) != num_slices:
-        state.imgThresholds = analyze_depth_histogram(
-            state.depthMapData, num_slices=num_slices)
+        state.imgThresholds = state.depth_thresholds(num_slices)
 
     logs_data.append(f"Thresholds: {state.imgThresholds}")
 
-    return True, logs_data
+    # the threshold sliders are rendered on the client from these values
+    return state.threshold_slider_values(), logs_data
 
 
 @app.callback(Output(C.STORE_APPSTATE_FILENAME, 'data', allow_duplicate=True),
@@ -377,9 +436,11 @@ def update_input_image(contents, classnames):
 
     content_type, content_string = contents.split(',')
 
+    # the data URI payload is known to be valid base64, so skip the b64decode wrapper
+    image = Image.open(io.BytesIO(binascii.a2b_base64(content_string)))
+
     # save the image data to the state
-    state.set_img_data(Image.open(
-        io.BytesIO(base64.b64decode(content_string))))
+    state.set_img_data(image)
 
     img_uri = state.serve_input_image()
 
@@ -405,14 +466,21 @@ def click_event(n_clicks, n_events, e, rect_data, mode, filename, logs_data):
     if filename is None:
         raise PreventUpdate()
 
+    # validate the trigger before looking up the state
+    t_id = ctx.triggered_id
+    if t_id == 'el':
+        if e is None or rect_data is None:
+            raise PreventUpdate()
+    elif t_id != C.SEG_MULTI_COMMIT:
+        raise ValueError(f"Unexpected trigger {t_id}")
+
     state = AppState.from_cache(filename)
 
-    t_id = ctx.triggered_id
     shiftClick = False
     ctrlClick = False
 
     if t_id == 'el':
-        if e is None or rect_data is None or state.imgData is None:
+        if state.imgData is None:
             raise PreventUpdate()
 
         pixel_x, pixel_y = find_pixel_from_event(state, e, rect_data)
@@ -427,8 +495,6 @@ def click_event(n_clicks, n_events, e, rect_data, mode, filename, logs_data):
 
         shiftClick = e["shiftKey"]
         ctrlClick = e["ctrlKey"]
-    elif t_id != C.SEG_MULTI_COMMIT:
-        raise ValueError(f"Unexpected trigger {t_id}")
 
     image = state.imgData
     if mode == 'segment':
@@ -471,9 +537,11 @@ def click_event(n_clicks, n_events, e, rect_data, mode, filename, logs_data):
     if state.slice_mask is None or not (shiftClick or ctrlClick):
         state.slice_mask = new_mask
     elif shiftClick:
-        state.slice_mask = np.maximum(state.slice_mask, new_mask)
+        cv2.max(state.slice_mask, new_mask, dst=state.slice_mask)
     elif ctrlClick:
-        state.slice_mask = np.minimum(state.slice_mask, 255 - new_mask)
+        # new_mask is not used afterwards, so it can hold the inverted mask
+        cv2.subtract(255, new_mask, dst=new_mask)
+        cv2.min(state.slice_mask, new_mask, dst=state.slice_mask)
 
     if state.slice_mask is not None:
         result = state.apply_mask(image, state.slice_mask)
@@ -496,8 +564,9 @@ def generate_depth_map_from_button(n_clicks, filename):
     return True
 
 
-@app.callback(Output(C.STORE_TRIGGER_UPDATE_DEPTHMAP, 'data'),
-              Output(C.DEPTHMAP_OUTPUT, 'children'),
+@app.callback(Output(C.LOADING_DEPTHMAP, 'display'),
+              Output(C.BTN_GENERATE_DEPTHMAP, 'disabled', allow_duplicate=True),
+              Output(C.PROGRESS_INTERVAL, 'disabled', allow_duplicate=True),
               Input(C.STORE_TRIGGER_GEN_DEPTHMAP, 'data'),
               State(C.STORE_APPSTATE_FILENAME, 'data'),
               State(C.DROPDOWN_DEPTH_MODEL, 'value'),
@@ -520,11 +589,41 @@ def generate_depth_map_callback(ignored_data, filename, model):
     if depth_model != state.depth_estimation_model:
         state.depth_estimation_model = depth_model
 
+    with depth_map_futures_lock:
+        depth_map_futures[filename] = DEPTH_EXECUTOR.submit(
+            generate_depth_map_for_state, state, np_image)
+
+    # the spinner and the disabled button stay until the progress interval
+    # polls the finished result
+    return 'show', True, False
+
+
+def generate_depth_map_for_state(state, np_image):
     state.depthMapData = generate_depth_map(
         np_image, model=state.depth_estimation_model, progress_callback=progress_callback)
     state.imgThresholds = None
 
-    return True, ""
+
+@app.callback(Output(C.STORE_TRIGGER_UPDATE_DEPTHMAP, 'data'),
+              Output(C.LOADING_DEPTHMAP, 'display', allow_duplicate=True),
+              Output(C.BTN_GENERATE_DEPTHMAP, 'disabled', allow_duplicate=True),
+              Input(C.PROGRESS_INTERVAL, 'n_intervals'),
+              State(C.STORE_APPSTATE_FILENAME, 'data'),
+              prevent_initial_call=True)
+def poll_depth_map_callback(n_intervals, filename):
+    with depth_map_futures_lock:
+        future = depth_map_futures.get(filename)
+        if future is None or not future.done():
+            raise PreventUpdate()
+        del depth_map_futures[filename]
+
+    try:
+        future.result()
+    except Exception as e:
+        print(f"Failed to generate depth map for {filename}: {e}")
+        return no_update, 'auto', False
+
+    return True, 'auto', False
 
 
 @app.callback(Output(C.CTR_DEPTH_MAP, 'children'),
@@ -536,14 +635,9 @@ def update_depth_map_callback(ignored_data, filename):
         raise PreventUpdate()
 
     state = AppState.from_cache(filename)
-    depth_map_pil = Image.fromarray(state.depthMapData)
-
-    buffered = io.BytesIO()
-    depth_map_pil.save(buffered, format="PNG")
-    img_str = base64.b64encode(buffered.getvalue()).decode('utf-8')
 
     return html.Img(
-        src='data:image/png;base64,{}'.format(img_str),
+        src=state.serve_depth_map(),
         className='w-full h-full object-contain',
         style={'height': '35vh'},
         id='depthmap-image'), ""
@@ -574,8 +668,7 @@ def delete_slice_request(n_clicks, filename, logs):
     state.delete_slice(state.selected_slice)
 
     # sufficient to just change the json.
-    state.to_file(filename, save_image_slices=False,
-                  save_depth_map=False, save_input_image=False)
+    save_state_json_deferred(filename, state)
 
     return state.serve_main_image(state.imgData), True, logs, ""
 
@@ -600,12 +693,18 @@ def copy_to_clipboard(n_clicks, filename, logs):
     if state.selected_slice is not None:
         image = state.slice_image_composed(
             state.selected_slice, CompositeMode.NONE)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        rgb = np.asarray(image)
     else:
-        image = state.imgData
-    image = np.array(image.convert('RGBA'))
-    image[:, :, 3] = state.slice_mask
+        rgb = state.img_array()
+
+    # assemble the RGBA clipboard directly instead of converting the image to RGBA first
+    clipboard_image = np.empty(rgb.shape[:2] + (4,), dtype=np.uint8)
+    clipboard_image[:, :, :3] = rgb[:, :, :3]
+    clipboard_image[:, :, 3] = state.slice_mask
 
-    state.clipboard_image = image
+    state.clipboard_image = clipboard_image
 
     logs.append("Copied mask to clipboard")
     return logs
@@ -642,8 +741,7 @@ def paste_clipboard_request(n_clicks, filename, logs):
         state.image_slices_filenames[state.selected_slice])
     state.image_slices_filenames[state.selected_slice] = image_filename
     state.save_image_slice(state.selected_slice)
-    state.to_file(filename, save_image_slices=False,
-                  save_depth_map=False, save_input_image=False)
+    save_state_json_deferred(filename, state)
 
     logs.append(f"Pasted clipboard to slice {state.selected_slice}")
     return True, logs, ""
@@ -680,8 +778,7 @@ def remove_mask_slice_request(n_clicks, filename, logs):
         state.image_slices_filenames[state.selected_slice])
     state.image_slices_filenames[state.selected_slice] = image_filename
     state.save_image_slice(state.selected_slice)
-    state.to_file(filename, save_image_slices=False,
-                  save_depth_map=False, save_input_image=False)
+    save_state_json_deferred(filename, state)
 
     logs.append(f"Removed mask from slice {state.selected_slice}")
     return True, logs, ""
@@ -721,8 +818,7 @@ def add_mask_slice_request(n_clicks, filename, logs):
         state.image_slices_filenames[state.selected_slice])
     state.image_slices_filenames[state.selected_slice] = image_filename
     state.save_image_slice(state.selected_slice)
-    state.to_file(filename, save_image_slices=False,
-                  save_depth_map=False, save_input_image=False)
+    save_state_json_deferred(filename, state)
 
     logs.append(f"Added mask to slice {state.selected_slice}")
     return True, logs, ""
@@ -748,8 +844,7 @@ def update_prompt_text(positive, negative, filename):
     state.positive_prompts[state.selected_slice] = positive
     state.negative_prompts[state.selected_slice] = negative
 
-    state.to_file(filename, save_image_slices=False,
-                  save_depth_map=False, save_input_image=False)
+    save_state_json_deferred(filename, state)
 
 
 @app.callback(Output(C.STORE_UPDATE_SLICE, 'data', allow_duplicate=True),
@@ -784,8 +879,7 @@ def create_single_slice_request(n_clicks, filename, logs):
             state.imgData, state.slice_mask, num_expand=EXPAND_MASK)
     state.selected_slice = state.add_slice(image, depth)
     state.save_image_slice(state.selected_slice)
-    state.to_file(filename, save_image_slices=False,
-                  save_depth_map=False, save_input_image=False)
+    save_state_json_deferred(filename, state)
 
     logs.append("Created a slice from the mask")
 
@@ -810,8 +904,7 @@ def balance_slices_request(n_clicks, filename, logs):
         raise PreventUpdate()
 
     state.balance_slices_depths()
-    state.to_file(filename, save_image_slices=False,
-                  save_depth_map=False, save_input_image=False)
+    save_state_json_deferred(filename, state)
 
     logs.append("Balanced slice depths")
 
@@ -923,20 +1016,6 @@ def update_slices(ignored_data, filename):
     return img_container, "", img_data
 
 
-@app.callback(
-    Output({'type': C.INPUT_SLICE_DEPTH, 'index': MATCH}, 'className'),
-    Input({'type': C.ID_SLICE_DEPTH_DISPLAY, 'index': MATCH}, 'n_clicks'),
-    State({'type': C.INPUT_SLICE_DEPTH,  'index': MATCH}, 'className'),
-    prevent_initial_call=True
-)
-def display_depth_input(n_clicks, class_name):
-    if n_clicks is None:
-        raise PreventUpdate()
-
-    class_name = class_name.replace('hidden', '')
-    return class_name
-
-
 @app.callback(
     Output(C.STORE_UPDATE_SLICE, 'data', allow_duplicate=True),
     Output(C.STORE_INPAINTING, 'data', allow_duplicate=True),
@@ -957,13 +1036,14 @@ def record_depth_input(values, n_submits, filename):
 
     # need to re-order and validate the depth values
     state = AppState.from_cache(filename)
+    if value == state.image_depths[index]:
+        raise PreventUpdate()
 
     new_index = state.change_slice_depth(index, value)
     if index != new_index:
         state.selected_slice = None
 
-    state.to_file(filename, save_image_slices=False,
-                  save_depth_map=False, save_input_image=False)
+    save_state_json_deferred(filename, state)
     return True, True
 
 
@@ -978,25 +1058,18 @@ def undo_slice(n_clicks_backwards, n_clicks_forwards, filename):
 
     state = AppState.from_cache(filename)
 
-    # don't need to use ctx.triggered_id since we are repaining the whole thing
-    index = None
-    forward = None
-    if any(n_clicks_backwards):
-        index = n_clicks_backwards.index(1)
-        forward = False
-    elif any(n_clicks_forwards):
-        index = n_clicks_forwards.index(1)
-        forward = True
-    else:
+    # newly rendered undo buttons trigger the callback without a click
+    if ctx.triggered_id is None or not ctx.triggered[0]['value']:
         raise PreventUpdate()
+    index = ctx.triggered_id['index']
+    forward = ctx.triggered_id['type'] == 'slice-undo-forwards'
 
     if not state.undo(index, forward=forward):
         print(f"Cannot undo slice {index} with forward {forward}")
         raise PreventUpdate()
 
     # only save the json with the updated file mapping
-    state.to_file(filename, save_image_slices=False,
-                  save_depth_map=False, save_input_image=False)
+    save_state_json_deferred(filename, state)
 
     return True
 
@@ -1014,15 +1087,12 @@ def generate_slices(ignored_data, filename):
     if state.depthMapData is None:
         raise PreventUpdate()
 
-    # XXX - refactor the state update into the AppState class
-    state.image_slices, state.image_depths = generate_image_slices(
-        np.array(state.imgData),
+    image_slices, image_depths = generate_image_slices(
+        state.img_array(),
         state.depthMapData,
         state.imgThresholds,
         num_expand=EXPAND_MASK)
-    state.image_slices_filenames = []
-    state.positive_prompts = ["" for _ in state.image_slices]
-    state.negative_prompts = ["" for _ in state.image_slices]
+    state.set_image_slices(image_slices, image_depths)
 
     print(f'Generated {len(state.image_slices)} image slices; saving to file')
     state.to_file(filename)
@@ -1030,8 +1100,8 @@ def generate_slices(ignored_data, filename):
     return True, ""
 
 
+# the slice overlays are toggled by a clientside callback
 @app.callback(Output(C.IMAGE, 'src'),
-              Output({'type': C.ID_SLICE_OVERLAY, 'index': ALL}, 'className'),
               Output(C.TEXT_POSITIVE_PROMPT, 'value', allow_duplicate=True),
               Output(C.TEXT_NEGATIVE_PROMPT, 'value', allow_duplicate=True),
               Output(C.STORE_INPAINTING, 'data', allow_duplicate=True),
@@ -1039,10 +1109,9 @@ def generate_slices(ignored_data, filename):
               Input({'type': C.ID_SLICE_OVERLAY, 'index': ALL}, 'n_clicks'),
               State({'type': 'slice', 'index': ALL}, 'id'),
               State({'type': 'slice', 'index': ALL}, 'src'),
-              State({'type': C.ID_SLICE_OVERLAY, 'index': ALL}, 'className'),
               State(C.STORE_APPSTATE_FILENAME, 'data'),
               prevent_initial_call=True)
-def display_slice(n_clicks, n_clicks_two, id, src, classnames, filename):
+def display_slice(n_clicks, n_clicks_two, id, src, filename):
     if (n_clicks is None or any(n_clicks) is False) and (n_clicks_two is None or any(n_clicks_two) is False):
         raise PreventUpdate()
     
@@ -1066,10 +1135,7 @@ def display_slice(n_clicks, n_clicks_two, id, src, classnames, filename):
         state.selected_slice = None
         result = state.serve_input_image()
 
-    for i in range(len(classnames)):
-        classnames[i] = 'overlay' if i == state.selected_slice else 'hidden'
-
-    return result, classnames, positive_prompt, negative_prompt, True
+    return result, positive_prompt, negative_prompt, True
 
 
 @app.callback(Output(C.LOGS_DATA, 'data', allow_duplicate=True),
@@ -1119,7 +1185,7 @@ def gltf_export(n_clicks, filename, camera_distance, max_distance, focal_length,
     gltf_path = export_state_as_gltf(
         state, filename, camera_distance, max_distance, focal_length, displacement_scale, support_dof=('dof' in dof))
 
-    return dcc.send_file(gltf_path, filename='scene.gltf'), ""
+    return download_url(gltf_path, 'scene.gltf'), ""
 
 
 @app.callback(Input(C.DROPDOWN_DEPTH_MODEL, 'value'),
@@ -1136,8 +1202,7 @@ def remember_depth_model(value, filename):
     if state.depth_model_name == value:
         raise PreventUpdate()
     state.depth_model_name = value
-    state.to_file(filename, save_image_slices=False,
-                  save_depth_map=False, save_input_image=False)
+    save_state_json_deferred(filename, state)
     return
 
 
@@ -1164,8 +1229,7 @@ def remember_camera_parameters(camera_distance, focal_length, max_distance, disp
     state.focal_length = focal_length
     state.max_distance = max_distance
     state.mesh_displacement = displacement
-    state.to_file(filename, save_image_slices=False,
-                  save_depth_map=False, save_input_image=False)
+    save_state_json_deferred(filename, state)
     return
 
 
@@ -1181,8 +1245,7 @@ def remember_inpaint_model(value, filename):
         raise PreventUpdate()
 
     state.inpainting_model_name = value
-    state.to_file(filename, save_image_slices=False,
-                  save_depth_map=False, save_input_image=False)
+    save_state_json_deferred(filename, state)
     return
 
 # XXX - this and the callback above can be chained to avoid code duplication
@@ -1227,20 +1290,27 @@ def export_state_as_gltf(
 
     depth_filenames = []
     if displacement_scale > 0:
-        for i, image in enumerate(state.image_slices):
-            print(f"Generating depth map for slice {i}")
-            depth_filename = state.depth_filename(i)
-            if not depth_filename.exists():
-                model = DepthEstimationModel(model=modelname)
-                if model != state.depth_estimation_model:
-                    state.depth_estimation_model = model
-                depth_map = generate_depth_map(
-                    image[:, :, :3], model=state.depth_estimation_model)
-                depth_map = postprocess_depth_map(
-                    depth_map, image[:, :, 3], final_blur=50)
-                Image.fromarray(depth_map).save(
-                    depth_filename, compress_level=1)
-            depth_filenames.append(depth_filename)
+        # keep the loaded model unless a different one was requested
+        depth_model = DepthEstimationModel(model=modelname)
+        if depth_model != state.depth_estimation_model:
+            state.depth_estimation_model = depth_model
+
+        depth_filenames = [state.depth_filename(i)
+                           for i in range(len(state.image_slices))]
+        missing = [i for i, depth_filename in enumerate(depth_filenames)
+                   if not depth_filename.exists()]
+
+        def save_depth_map(i, depth_map):
+            depth_map = postprocess_depth_map(
+                depth_map, state.image_slices[i][:, :, 3], final_blur=50)
+            Image.fromarray(depth_map).save(
+                depth_filenames[i], compress_level=1)
+
+        # run the slices without a depth map through the model in batches; the
+        # post-processing of a batch overlaps with the inference of the next one
+        generate_slice_depth_maps(
+            state.image_slices, missing, state.depth_estimation_model,
+            save_depth_map, batch_size=DEPTH_BATCH_SIZE)
 
     # check whether we have upscaled slices we should use
     slices_filenames = []
@@ -1279,7 +1349,7 @@ def download_image(n_clicks, filename):
 
     image_path = state.image_slices_filenames[index]
 
-    return dcc.send_file(image_path, Path(state.image_slices_filenames[index]).name)
+    return download_url(image_path, Path(image_path).name)
 
 
 @app.callback(Output(C.STORE_UPDATE_SLICE, 'data', allow_duplicate=True),
@@ -1304,8 +1374,10 @@ def slice_upload(contents, filename, logs):
     aspect_ratio = state.image_slices[index].shape[1] / \
         state.image_slices[index].shape[0]
 
+    # decode the data URI payload without splitting the whole string
     content = contents[index]
-    image = Image.open(io.BytesIO(base64.b64decode(content.split(',')[1])))
+    image = Image.open(io.BytesIO(
+        binascii.a2b_base64(content[content.find(',') + 1:])))
     image = image.convert('RGBA')
 
     if image.size[0] / image.size[1] != aspect_ratio:
@@ -1318,7 +1390,8 @@ def slice_upload(contents, filename, logs):
     # add a version number to the filename and increase if it already exists
     image_filename = filename_add_version(state.image_slices_filenames[index])
     state.image_slices_filenames[index] = image_filename
-    state.save_image_slice(index)
+    # only the uploaded slice changed; favor a fast write while the user iterates
+    state.save_image_slice(index, compress_level=1)
     state.to_file(filename, save_image_slices=False,
                   save_depth_map=False, save_input_image=False)
 
@@ -1520,9 +1593,8 @@ def restore_state(contents, logs):
     if contents is None:
         raise PreventUpdate()
 
-    # decode the contents into json
-    content_type, content_string = contents.split(',')
-    decoded_contents = base64.b64decode(content_string).decode('utf-8')
+    # decode the contents; orjson parses the utf-8 bytes directly
+    decoded_contents = binascii.a2b_base64(contents[contents.find(',') + 1:])
     state = AppState.from_json(decoded_contents)
     state.fill_from_files(state.filename)
     AppState.cache[state.filename] = state  # XXX - this may be too hacky
@@ -1530,12 +1602,10 @@ def restore_state(contents, logs):
     logs.append(f"Restored state from {state.filename}")
 
     # XXX - refactor this to be triggered by a write to restore-state
-    buffered = io.BytesIO()
-    state.imgData.save(buffered, format="PNG")
-    img_data = base64.b64encode(buffered.getvalue()).decode('utf-8')
-    img_data = f"data:image/png;base64,{img_data}"
+    # the input image was just read from the state directory, so serve it from there
+    img_data = state.serve_input_image()
 
-    return state.filename, True, img_data, True, state.num_slices, logs
+    return state.filename, True, img_data, state.threshold_slider_values(), state.num_slices, logs
 
 
 @app.callback(Output(C.LOGS_DATA, 'data', allow_duplicate=True),
@@ -1555,17 +1625,6 @@ def save_state(n_clicks, filename, logs):
     return logs
 
 
-@app.callback(Output(C.STORE_CURRENT_TAB, 'data', allow_duplicate=True),
-              Input({'type': 'tab-content-main', 'index': ALL}, 'className'),
-              prevent_initial_call=True)
-def update_current_tab(classnames):
-    names = ['Mode', 'Segmentation', 'Inpainting', 'Export', 'Configuration']
-    for i, classname in enumerate(classnames):
-        if 'hidden' not in classname:
-            return names[i]
-    return no_update
-
-
 if __name__ == '__main__':
     os.environ['DISABLE_TELEMETRY'] = 'YES'
     os.environ['PYTORCH_ENABLE_MPS_FALLBACK'] = '1'
@@ -1577,6 +1636,12 @@ if __name__ == '__main__':
                         help='Either "all" or "default"')
     args = parser.parse_args()
 
+    # compile the slice kernels now rather than on the first slice edit
+    blend_with_alpha(np.zeros((1, 1, 4), dtype=np.uint8),
+                     np.zeros((1, 1, 4), dtype=np.uint8))
+    remove_mask_from_alpha(np.zeros((1, 1, 4), dtype=np.uint8),
+                           np.zeros((1, 1), dtype=np.uint8))
+
     if not serving.is_running_from_reloader():
         if args.prefetch_models in ['all', 'default']:
             print("Prefetching models")
@@ -1593,4 +1658,6 @@ if __name__ == '__main__':
                 f'Invalid prefetch models argument: {args.prefetch_models}; use "all" or "default"')
             exit(1)
 
-    app.run_server(port=args.port, debug=True)
+    # the threaded server already runs callbacks concurrently; skip the hot reload
+    # polling and asset watching of the dev tools
+    app.run_server(port=args.port, debug=True, dev_tools_hot_reload=False)